@@ -1,10 +1,13 @@
+import json
 import logging
 import time
 import webapp2
 from webapp2_extras import jinja2
 
+import costmodel
 import mandelbrot
 import models
+import pngencoder
 
 # Disable autoflush, for now
 from google.appengine.api.logservice import logservice
@@ -16,21 +19,83 @@ class BackendTileHandler(webapp2.RequestHandler):
     xmin, xsize, ymin, ysize = (float(self.request.GET[x])
                                 for x in ('xmin', 'xsize', 'ymin', 'ysize'))
     width, height = (int(self.request.GET[x]) for x in ('width', 'height'))
+    limit = int(self.request.GET.get('limit', mandelbrot.LIMIT))
+    orbits = self.request.GET.get('orbits') == '1'
+    antialias = int(self.request.GET.get('antialias', 0))
+    mode = self.request.GET.get('mode', mandelbrot.MODE_ESCAPE)
+    if mode not in mandelbrot.MODES:
+      self.abort(400, 'Unknown render mode %r' % (mode,))
+    if orbits and mode != mandelbrot.MODE_ESCAPE:
+      self.abort(400, 'Orbits are only available in %s mode' %
+                 mandelbrot.MODE_ESCAPE)
+
+    if self.request.GET.get('profile') == '1':
+      profile = mandelbrot.profile(width, height, limit, xmin, xsize, ymin,
+                                   ysize, mandelbrot.ESCAPE)
+      self.response.headers['Content-Type'] = 'application/json'
+      self.response.out.write(json.dumps(profile))
+      return
 
     logging.info("Starting render")
     start = time.time()
-    image, operation_cost = mandelbrot.render_tile(xmin, xsize, ymin, ysize,
-                                                   width, height)
+    result = mandelbrot.render_tile(xmin, xsize, ymin, ysize, width, height,
+                                    limit, antialias, mode)
     elapsed = time.time() - start
     logging.info("Image required %d operations, completing in %.2f seconds.",
-                 operation_cost, elapsed)
+                 result.cost, elapsed)
 
     self.response.headers['Content-Type'] = 'image/png'
     self.response.headers['X-Render-Time'] = '%s' % elapsed
-    self.response.headers['X-Operation-Cost'] = '%s' % operation_cost
-    image.save(self.response.out, 'PNG')
+    self.response.headers['X-Operation-Cost'] = '%s' % result.cost
+    self.response.headers['X-Late-Escapes'] = '%s' % result.late_escapes
+    self.response.headers['X-Cost-Map'] = ','.join(
+        str(cost) for cost in result.cost_map(costmodel.COST_MAP_COLUMNS))
+    encode_start = time.time()
+    data = pngencoder.encode(result.pixels)
+    self.response.headers['X-Encode-Time'] = '%s' % (time.time() - encode_start)
+    self.response.out.write(data)
+    if orbits:
+      # Append the unescaped orbits, so the tile can be deepened later.
+      state_data = result.state.to_string()
+      self.response.headers['X-Orbits-Length'] = '%d' % len(state_data)
+      self.response.out.write(state_data)
+
+
+class BackendBatchHandler(webapp2.RequestHandler):
+  """Renders many small rectangles, such as sub-tile levels, in one call.
+
+  The request body is a JSON object with a 'limit' and a list of 'rects',
+  each [xmin, ymin, xsize, ysize, width, height]. The response is each
+  rectangle's PNG in turn, with their lengths, costs and late escapes in
+  comma-separated headers.
+  """
+
+  def post(self):
+    request = json.loads(self.request.body)
+    limit = int(request.get('limit', mandelbrot.LIMIT))
+    rects = [tuple(map(float, rect[:4])) + tuple(map(int, rect[4:6]))
+             for rect in request['rects']]
+
+    start = time.time()
+    results = mandelbrot.render_batch(rects, limit, mandelbrot.ESCAPE)
+    elapsed = time.time() - start
+    logging.info("Batch of %d images required %d operations, completing in "
+                 "%.2f seconds.", len(results),
+                 sum(result.cost for result in results), elapsed)
+
+    images = [pngencoder.encode(result.pixels) for result in results]
+    self.response.headers['Content-Type'] = 'application/octet-stream'
+    self.response.headers['X-Render-Time'] = '%s' % elapsed
+    self.response.headers['X-Image-Lengths'] = ','.join(
+        str(len(image)) for image in images)
+    self.response.headers['X-Operation-Costs'] = ','.join(
+        str(result.cost) for result in results)
+    self.response.headers['X-Late-Escapes'] = ','.join(
+        str(result.late_escapes) for result in results)
+    self.response.out.write(''.join(images))
 
 
 application = webapp2.WSGIApplication([
     ('/backend/render_tile', BackendTileHandler),
+    ('/backend/render_batch', BackendBatchHandler),
 ], debug=True)
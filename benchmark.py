@@ -0,0 +1,418 @@
+"""Offline benchmarks for the tile rendering pipeline.
+
+Run from the application directory, for example:
+
+  python benchmark.py encode
+  python benchmark.py render --output results.json --baseline benchmark_baseline.json
+  python benchmark.py kernel --baseline benchmark_baseline.json
+  python benchmark.py distance
+  python benchmark.py batch
+  python benchmark.py large --width 16384 --height 16384 --output big.png
+
+benchmark_baseline.json holds reference results for the render benchmark.
+Operation counts and output checksums should match exactly on any machine;
+wall times are only comparable on the machine the baseline was recorded on,
+so regenerate it with --output before judging a kernel change by speed.
+"""
+
+import argparse
+import cStringIO
+import hashlib
+import json
+import multiprocessing
+import resource
+import sys
+import time
+
+import numpy
+from PIL import Image
+
+import mandelbrot
+import pngencoder
+
+# A sample of tiles from across the pyramid, as (level, x, y).
+SAMPLE_TILES = [
+    (8, 0, 0),
+    (10, 1, 1),
+    (12, 6, 5),
+    (16, 120, 90),
+    (24, 32035, 45661),
+    (24, 32037, 45663),
+    (24, 32041, 45663),
+    (24, 32040, 45661),
+]
+
+# Reference tiles for the render benchmark, as (category, level, x, y).
+REFERENCE_TILES = [
+    ('shallow', 8, 0, 0),
+    ('shallow', 10, 1, 1),
+    ('boundary', 16, 106, 136),
+    ('boundary', 24, 32040, 45661),
+    ('deep', 24, 32035, 45661),
+    ('deep', 32, 8202431, 11689462),
+    ('interior', 12, 10, 8),
+    ('interior', 14, 38, 32),
+]
+
+NUM_STRIPES = 16 # As main.NUM_STRIPES
+REGRESSION_THRESHOLD = 0.1 # Slowdown relative to baseline counted as a regression
+
+
+def render_sample(tiles=SAMPLE_TILES):
+  """Renders each tile in tiles, returning a list of PIL Images."""
+  images = []
+  for level, x, y in tiles:
+    xmin, ymin, xsize, ysize, tilesize = mandelbrot.calculate_bounds(
+        level, x, y)
+    result = mandelbrot.render_tile(xmin, xsize, ymin, ysize, tilesize,
+                                    tilesize)
+    images.append(result.image())
+  return images
+
+
+def _time_encoder(encoder, images, repeat):
+  """Returns (seconds per image, total bytes) for an encoder function."""
+  start = time.time()
+  for i in range(repeat):
+    sizes = [len(encoder(img)) for img in images]
+  elapsed = time.time() - start
+  return elapsed / (repeat * len(images)), sum(sizes)
+
+
+def _encoder_error(encoder, images):
+  """Returns (fraction of pixels changed, largest channel error).
+
+  Each image is encoded with encoder and decoded again with PIL; a lossless
+  encoder gives (0.0, 0).
+  """
+  changed = 0
+  total = 0
+  max_error = 0
+  for img in images:
+    expected = numpy.asarray(img.convert('RGB')).astype(numpy.int16)
+    decoded = Image.open(cStringIO.StringIO(encoder(img))).convert('RGB')
+    error = numpy.abs(numpy.asarray(decoded).astype(numpy.int16) - expected)
+    changed += numpy.count_nonzero(error.max(axis=2))
+    total += error.shape[0] * error.shape[1]
+    max_error = max(max_error, int(error.max()))
+  return changed / float(total), max_error
+
+
+def _pil_encode(img):
+  data = cStringIO.StringIO()
+  img.save(data, 'PNG')
+  return data.getvalue()
+
+
+def benchmark_encode(args):
+  """Compares PNG encoders over the sample tiles."""
+  images = render_sample()
+  encoders = [('PIL RGB', _pil_encode)]
+  for level in args.levels:
+    encoders.append((
+        'palette z%d' % level,
+        lambda img, level=level: pngencoder.encode(img, level=level)))
+    encoders.append((
+        'RGB z%d' % level,
+        lambda img, level=level: pngencoder.encode(img, palette=False,
+                                                   level=level)))
+    encoders.append((
+        'quantized z%d' % level,
+        lambda img, level=level: pngencoder.encode(img, level=level,
+                                                   quantize=True)))
+
+  baseline = None
+  print '%-16s %12s %12s %8s %10s %8s' % ('encoder', 'ms/tile', 'bytes',
+                                          'ratio', 'changed', 'maxerr')
+  for name, encoder in encoders:
+    per_image, size = _time_encoder(encoder, images, args.repeat)
+    changed, max_error = _encoder_error(encoder, images)
+    if baseline is None:
+      baseline = size
+    print '%-16s %12.2f %12d %8.3f %9.2f%% %8d' % (
+        name, per_image * 1000, size, size / float(baseline), changed * 100,
+        max_error)
+
+
+def run_kernel(level, x, y):
+  """Renders a whole tile with a single call to mandelbrot.mandelbrot()."""
+  xmin, ymin, xsize, ysize, tilesize = mandelbrot.calculate_bounds(level, x, y)
+  pixels, opcount = mandelbrot.mandelbrot(
+      tilesize, tilesize, mandelbrot.choose_limit(level), xmin, xsize, ymin,
+      ysize, mandelbrot.ESCAPE)
+  return pixels, opcount
+
+
+def run_pipeline(level, x, y):
+  """Renders a tile the way the application does, minus the network.
+
+  Each stripe is rendered and encoded as the backend would, then decoded and
+  pasted into the tile, which is encoded for storage.
+  """
+  limit = mandelbrot.choose_limit(level)
+  stripes = mandelbrot.tile_stripes(level, x, y, NUM_STRIPES)
+  tilesize, stripe_height = stripes[0][4:6]
+  img = Image.new('RGB', (tilesize, tilesize))
+  opcount = 0
+  for stripe_num, (xmin, ymin, xsize, ysize, width, height) in enumerate(
+      stripes):
+    result = mandelbrot.render_tile(xmin, xsize, ymin, ysize, width, height,
+                                    limit)
+    opcount += result.cost
+    stripe = cStringIO.StringIO(pngencoder.encode(result.pixels))
+    img.paste(Image.open(stripe), (0, stripe_num * stripe_height))
+  pngencoder.encode(img)
+  return numpy.asarray(img), opcount
+
+
+def _measure(case):
+  """Times one benchmark case. Run in a fresh process to isolate memory use.
+
+  Returns:
+    A dict of measurements.
+  """
+  stage, level, x, y, repeat = case
+  func = {'kernel': run_kernel, 'pipeline': run_pipeline}[stage]
+  base_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  times = []
+  for i in range(repeat):
+    start = time.time()
+    pixels, opcount = func(level, x, y)
+    times.append(time.time() - start)
+  peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  wall_time = min(times)
+  return {
+      'wall_time': wall_time,
+      'opcount': opcount,
+      'pixels_per_second': pixels.shape[0] * pixels.shape[1] / wall_time,
+      'ops_per_second': opcount / wall_time,
+      # ru_maxrss is in kilobytes on Linux.
+      'peak_memory_kb': peak_memory - base_memory,
+      'checksum': hashlib.md5(pixels.tostring()).hexdigest(),
+  }
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+  """Compares benchmark results with a baseline.
+
+  Returns:
+    A list of (case, message) tuples describing regressions: slowdowns
+    beyond threshold, more operations, or different output.
+  """
+  regressions = []
+  for name, result in sorted(results.iteritems()):
+    base = baseline.get(name)
+    if base is None:
+      continue
+    if result['wall_time'] > base['wall_time'] * (1 + threshold):
+      regressions.append((name, 'wall time %.3fs -> %.3fs' % (
+          base['wall_time'], result['wall_time'])))
+    if result['opcount'] > base['opcount']:
+      regressions.append((name, 'opcount %d -> %d' % (
+          base['opcount'], result['opcount'])))
+    if result['checksum'] != base['checksum']:
+      regressions.append((name, 'output changed'))
+  return regressions
+
+
+def benchmark_render(args):
+  """Times the kernel and tile pipeline over the reference tiles."""
+  cases = []
+  for category, level, x, y in REFERENCE_TILES:
+    for stage in ('kernel', 'pipeline'):
+      name = '%s/%s/%d/%d/%d' % (stage, category, level, x, y)
+      cases.append((name, (stage, level, x, y, args.repeat)))
+
+  pool = multiprocessing.Pool(1, maxtasksperchild=1)
+  results = {}
+  print '%-40s %9s %12s %12s %10s' % ('case', 'seconds', 'opcount',
+                                       'pixels/s', 'peak KB')
+  for name, case in cases:
+    result = results[name] = pool.apply(_measure, (case,))
+    print '%-40s %9.3f %12d %12d %10d' % (
+        name, result['wall_time'], result['opcount'],
+        result['pixels_per_second'], result['peak_memory_kb'])
+  pool.close()
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    for name, message in regressions:
+      print 'REGRESSION %s: %s' % (name, message)
+    if regressions:
+      sys.exit(1)
+
+
+def benchmark_kernel(args):
+  """Measures the iteration rate of mandelbrot.mandelbrot() in process."""
+  baseline = {}
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+  print '%-32s %9s %10s %10s %8s' % ('tile', 'seconds', 'Mops/s',
+                                     'base Mops/s', 'speedup')
+  for category, level, x, y in REFERENCE_TILES:
+    (pixels, opcount), elapsed = _best_time(lambda: run_kernel(level, x, y),
+                                            args.repeat)
+    name = '%s/%d/%d/%d' % (category, level, x, y)
+    rate = opcount / elapsed
+    base = baseline.get('kernel/' + name)
+    if base:
+      print '%-32s %9.3f %10.1f %10.1f %8.2f' % (
+          name, elapsed, rate / 1e6, base['ops_per_second'] / 1e6,
+          rate / base['ops_per_second'])
+    else:
+      print '%-32s %9.3f %10.1f' % (name, elapsed, rate / 1e6)
+
+
+def render_large(args):
+  """Renders a large image in row blocks, reporting its peak memory use."""
+  xsize = mandelbrot.XMAX - mandelbrot.XMIN
+  ysize = xsize * args.height / args.width
+  ymin = -ysize / 2
+  base_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  start = time.time()
+  if args.output and args.output.endswith('.npy'):
+    out = numpy.lib.format.open_memmap(args.output, 'w+', numpy.uint8,
+                                       (args.height, args.width, 3))
+    cost = mandelbrot.render_large(out, args.limit, mandelbrot.XMIN, xsize,
+                                   ymin, ysize, mandelbrot.ESCAPE,
+                                   args.budget)
+    out.flush()
+  else:
+    fh = open(args.output or '/dev/null', 'wb')
+    writer = pngencoder.PNGWriter(fh, args.width, args.height)
+    cost = 0
+    for top, pixels, block_cost in mandelbrot.render_rows(
+        args.width, args.height, args.limit, mandelbrot.XMIN, xsize, ymin,
+        ysize, mandelbrot.ESCAPE, args.budget):
+      writer.write(pixels)
+      cost += block_cost
+    writer.close()
+    fh.close()
+  elapsed = time.time() - start
+  peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  print '%dx%d: %.1fs, %d operations, peak memory %d KB' % (
+      args.width, args.height, elapsed, cost, peak_memory - base_memory)
+
+
+def _best_time(func, repeat):
+  """Returns (result, fastest time) over repeat calls of func."""
+  times = []
+  for i in range(repeat):
+    start = time.time()
+    result = func()
+    times.append(time.time() - start)
+  return result, min(times)
+
+
+def check_distance(args):
+  """Checks that skipping blocks in distance mode leaves tiles unchanged."""
+  tiles = [(level, x, y) for category, level, x, y in REFERENCE_TILES]
+  tiles = sorted(set(tiles + SAMPLE_TILES))
+  failures = []
+  print '%-24s %12s %9s' % ('tile', 'opcount', 'changed')
+  for level, x, y in tiles:
+    xmin, ymin, xsize, ysize, tilesize = mandelbrot.calculate_bounds(
+        level, x, y)
+    limit = mandelbrot.choose_limit(level)
+    results = [mandelbrot.render_distance(
+                   tilesize, tilesize, limit, xmin, xsize, ymin, ysize,
+                   mandelbrot.DISTANCE_ESCAPE, block)
+               for block in (1, mandelbrot.DISTANCE_BLOCK)]
+    exact, skipped = results
+    changed = (exact.pixels != skipped.pixels).any(axis=2).mean()
+    name = '%d/%d/%d' % (level, x, y)
+    print '%-24s %12d %9.5f' % (name, skipped.cost, changed)
+    if changed:
+      failures.append(name)
+  for name in failures:
+    print 'CHANGED %s' % (name,)
+  if failures:
+    sys.exit(1)
+
+
+def check_batch(args):
+  """Checks that render_batch() matches rendering each stripe separately."""
+  failures = []
+  print '%-24s %8s %8s' % ('tile', 'limit', 'result')
+  for level, x, y in SAMPLE_TILES:
+    rects = mandelbrot.tile_stripes(level, x, y, NUM_STRIPES)
+    # Include limits too small to have any late iterations.
+    for limit in (1, 3, mandelbrot.choose_limit(level)):
+      batch = mandelbrot.render_batch(rects, limit, mandelbrot.ESCAPE)
+      same = len(batch) == len(rects)
+      for result, (xmin, ymin, xsize, ysize, width, height) in zip(batch,
+                                                                  rects):
+        single = mandelbrot.render(width, height, limit, xmin, xsize, ymin,
+                                   ysize, mandelbrot.ESCAPE)
+        same = same and (
+            (result.pixels == single.pixels).all() and
+            (result.counts == single.counts).all() and
+            (result.state.index == single.state.index).all() and
+            result.cost == single.cost and
+            result.late_escapes == single.late_escapes)
+      name = '%d/%d/%d' % (level, x, y)
+      print '%-24s %8d %8s' % (name, limit, same and 'ok' or 'DIFFERENT')
+      if not same:
+        failures.append('%s limit %d' % (name, limit))
+  if mandelbrot.render_batch([], 1, mandelbrot.ESCAPE) != []:
+    failures.append('no rects')
+  for name in failures:
+    print 'DIFFERENT %s' % (name,)
+  if failures:
+    sys.exit(1)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  subparsers = parser.add_subparsers()
+
+  encode = subparsers.add_parser('encode', help=benchmark_encode.__doc__)
+  encode.add_argument('--repeat', type=int, default=3)
+  encode.add_argument('--levels', type=int, nargs='+', default=[1, 6, 9],
+                      help='zlib compression levels to compare')
+  encode.set_defaults(func=benchmark_encode)
+
+  render = subparsers.add_parser('render', help=benchmark_render.__doc__)
+  render.add_argument('--repeat', type=int, default=3)
+  render.add_argument('--output', help='file to write JSON results to')
+  render.add_argument('--baseline', help='JSON results to compare against')
+  render.add_argument('--threshold', type=float,
+                      default=REGRESSION_THRESHOLD,
+                      help='slowdown counted as a regression')
+  render.set_defaults(func=benchmark_render)
+
+  kernel = subparsers.add_parser('kernel', help=benchmark_kernel.__doc__)
+  kernel.add_argument('--repeat', type=int, default=3)
+  kernel.add_argument('--baseline',
+                      help='JSON results from the render benchmark')
+  kernel.set_defaults(func=benchmark_kernel)
+
+  distance = subparsers.add_parser('distance', help=check_distance.__doc__)
+  distance.set_defaults(func=check_distance)
+
+  batch = subparsers.add_parser('batch', help=check_batch.__doc__)
+  batch.set_defaults(func=check_batch)
+
+  large = subparsers.add_parser('large', help=render_large.__doc__)
+  large.add_argument('--width', type=int, default=8192)
+  large.add_argument('--height', type=int, default=8192)
+  large.add_argument('--limit', type=int, default=mandelbrot.LIMIT)
+  large.add_argument('--budget', type=int, default=mandelbrot.CHUNK_BUDGET,
+                     help='bytes of working memory to use')
+  large.add_argument('--output',
+                     help='PNG file to write, or .npy for a memory-mapped '
+                          'array; by default the PNG is discarded')
+  large.set_defaults(func=render_large)
+
+  args = parser.parse_args()
+  args.func(args)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,193 @@
+"""Predicts the cost of rendering tiles from the costs of their ancestors.
+
+Each cached tile stores a coarse cost map: the number of iterations spent in
+each cell of a grid over the tile, one row per stripe. Since cost per unit of
+area changes smoothly as you zoom in, the cost of a tile that hasn't been
+rendered yet can be estimated from the part of its nearest cached ancestor's
+cost map that covers it, scaled up by the increase in pixel density.
+"""
+
+import struct
+
+import numpy
+from ndb import tasklets
+
+import mandelbrot
+import models
+
+COST_MAP_COLUMNS = 8 # Cost map cells across each stripe
+MAX_DEPTH = 6 # Most levels up to look for a cached ancestor
+
+
+def pack_cost_map(cost_map):
+  """Serializes a 2-dimensional cost map for storage."""
+  rows, columns = cost_map.shape
+  return (struct.pack('<II', rows, columns) +
+          cost_map.astype('<u8').tostring())
+
+
+def unpack_cost_map(data):
+  """Deserializes a cost map serialized with pack_cost_map()."""
+  rows, columns = struct.unpack_from('<II', data)
+  cost_map = numpy.frombuffer(data, '<u8', rows * columns,
+                              struct.calcsize('<II'))
+  return cost_map.astype(numpy.float64).reshape(rows, columns)
+
+
+def _overlaps(cells, start, end):
+  """Returns how much of each of cells equal divisions of [0, 1) is covered.
+
+  Args:
+    cells: The number of divisions.
+    start, end: The covered range, as fractions of [0, 1).
+  Returns:
+    An array of the fraction of each division lying within [start, end).
+  """
+  edges = numpy.arange(cells + 1) / float(cells)
+  lower = numpy.maximum(edges[:-1], start)
+  upper = numpy.minimum(edges[1:], end)
+  return numpy.maximum(upper - lower, 0) * cells
+
+
+def region_cost(cost_map, left, top, right, bottom):
+  """Returns the cost of a rectangular region of a cost map.
+
+  Cost is assumed to be evenly distributed within each cell.
+
+  Args:
+    cost_map: A 2-dimensional cost map.
+    left, top, right, bottom: The region's bounds, as fractions of the map.
+  """
+  rows, columns = cost_map.shape
+  weights = numpy.outer(_overlaps(rows, top, bottom),
+                        _overlaps(columns, left, right))
+  return float((cost_map * weights).sum())
+
+
+def ancestor(level, x, y, ancestor_level):
+  """Returns the position of the tile at ancestor_level containing a tile."""
+  shift = (max(level - mandelbrot.TILE_SIZE_BITS, 0) -
+           max(ancestor_level - mandelbrot.TILE_SIZE_BITS, 0))
+  return ancestor_level, x >> shift, y >> shift
+
+
+class CostModel(object):
+  """Predicts tile and stripe costs from a set of known cost maps."""
+
+  def __init__(self, cost_maps=None):
+    """Constructor.
+
+    Args:
+      cost_maps: A dict mapping (level, x, y) tuples to cost maps.
+    """
+    self.cost_maps = cost_maps or {}
+
+  def add(self, level, x, y, cost_map):
+    self.cost_maps[(level, x, y)] = cost_map
+
+  def nearest_ancestor(self, level, x, y, max_depth=MAX_DEPTH):
+    """Returns the position of the closest strict ancestor with a cost map.
+
+    Returns None if no such ancestor is within max_depth levels.
+    """
+    for ancestor_level in range(level - 1, max(level - max_depth, 0) - 1, -1):
+      position = ancestor(level, x, y, ancestor_level)
+      if position in self.cost_maps:
+        return position
+    return None
+
+  def predict(self, level, x, y, left=0.0, top=0.0, right=1.0, bottom=1.0):
+    """Predicts the cost of rendering a tile, or part of one.
+
+    Args:
+      level, x, y: The tile's position.
+      left, top, right, bottom: The part of the tile, as fractions of it.
+    Returns:
+      The expected number of iterations, or None if there's no data.
+    """
+    position = self.nearest_ancestor(level, x, y)
+    if position is None:
+      return None
+    cost_map = self.cost_maps[position]
+    axmin, aymin, axsize, aysize, asize = mandelbrot.calculate_bounds(
+        *position)
+    xmin, ymin, xsize, ysize, tilesize = mandelbrot.calculate_bounds(
+        level, x, y)
+    # The region's bounds, as fractions of the ancestor tile.
+    region = (
+        (xmin + xsize * left - axmin) / axsize,
+        (ymin + ysize * top - aymin) / aysize,
+        (xmin + xsize * right - axmin) / axsize,
+        (ymin + ysize * bottom - aymin) / aysize,
+    )
+    area = (region[2] - region[0]) * (region[3] - region[1])
+    if area <= 0:
+      return 0.0
+    # Scale by how many more pixels cover the region in this tile.
+    density = (tilesize * tilesize * (right - left) * (bottom - top) /
+               (asize * asize * area))
+    return region_cost(cost_map, *region) * density
+
+  def predict_stripes(self, level, x, y, num_stripes):
+    """Predicts the cost of each horizontal stripe of a tile.
+
+    Returns:
+      A list of expected costs, or None if there's no data.
+    """
+    if self.nearest_ancestor(level, x, y) is None:
+      return None
+    return [self.predict(level, x, y, 0.0, float(i) / num_stripes,
+                         1.0, float(i + 1) / num_stripes)
+            for i in range(num_stripes)]
+
+
+@tasklets.tasklet
+def load(level, x, y, max_depth=MAX_DEPTH):
+  """Fetches the cost maps of a tile's cached ancestors.
+
+  Returns:
+    A CostModel holding the cost maps of the tile's ancestors.
+  """
+  positions = [ancestor(level, x, y, ancestor_level)
+               for ancestor_level in range(max(level - max_depth, 0), level)]
+  keys = [models.CachedTile.key_for_tile('exabrot', *position)
+          for position in positions]
+  tiles = yield [key.get_async() for key in keys]
+  model = CostModel()
+  for position, tile in zip(positions, tiles):
+    if tile is not None and tile.cost_map is not None:
+      model.add(*(position + (unpack_cost_map(tile.cost_map),)))
+  raise tasklets.Return(model)
+
+
+@tasklets.tasklet
+def predict(level, x, y):
+  """Predicts the cost of rendering a tile from its cached ancestors.
+
+  Returns:
+    The expected number of iterations, or None if there's no data.
+  """
+  model = yield load(level, x, y)
+  raise tasklets.Return(model.predict(level, x, y))
+
+
+def error_report(tiles):
+  """Measures how well cost maps predict the costs of their descendants.
+
+  Args:
+    tiles: An iterable of CachedTile entities.
+  Returns:
+    A list of (level, count, mean error, median error) tuples, one per
+    level, where errors are relative to the actual cost of each tile.
+  """
+  tiles = [tile for tile in tiles if tile.cost_map is not None]
+  model = CostModel(dict((tile.position, unpack_cost_map(tile.cost_map))
+                         for tile in tiles))
+  errors = {}
+  for tile in tiles:
+    predicted = model.predict(*tile.position)
+    if predicted is not None and tile.operation_cost:
+      error = abs(predicted - tile.operation_cost) / tile.operation_cost
+      errors.setdefault(tile.level, []).append(error)
+  return [(level, len(errors[level]), numpy.mean(errors[level]),
+           numpy.median(errors[level])) for level in sorted(errors)]
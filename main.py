@@ -2,6 +2,9 @@ import cStringIO
 import datetime
 import logging
 import math
+import numpy
+import random
+import threading
 import time
 import urllib
 import urlparse
@@ -9,14 +12,19 @@ import webapp2
 from PIL import Image
 from google.appengine.api import backends
 from google.appengine.api import files
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.api import urlfetch
 from google.appengine.ext import blobstore
 from google.appengine.runtime import apiproxy_errors
 from ndb import context, model, tasklets
 from webapp2_extras import jinja2
 
+import costmodel
 import mandelbrot
 import models
+import pngencoder
+import tracing
 
 # Disable autoflush, for now
 from google.appengine.api.logservice import logservice
@@ -27,6 +35,64 @@ NUM_STRIPES = 16
 PARALLELISM = 4
 NUM_BACKENDS = 6
 
+RERENDER_QUEUE = 'rerender' # Pull queue of stale tiles awaiting re-render
+RERENDER_SCAN = 100 # Queued stale tiles considered per re-render run
+RERENDER_BATCH = 8 # Hottest stale tiles re-rendered per re-render run
+RERENDER_PARALLELISM = 1 # Tiles re-rendered at once, to spare the backends
+RERENDER_LEASE = 120 # Seconds a leased re-render task is held
+STALE_HITS_NAMESPACE = 'stale_hits' # Memcache namespace for request counts
+BLOB_GRACE_PERIOD = 300 # Seconds before a replaced tile's blob is deleted
+SAVE_ORBITS = False # Store unescaped orbits, so tiles can be deepened later
+DEEPEN_QUEUE = 'deepen' # Push queue for raising tiles' iteration limits
+DEEPEN_NAMESPACE = 'deepen' # Memcache namespace for queued deepen passes
+DEEPEN_LOCK_TIME = 60 # Seconds before a shallow tile may be queued again
+DEFAULT_STRIPE_COST = 1 # Assumed stripe cost when there's no prediction
+PROGRESSIVE = True # Serve previews of missing tiles while they're rendered
+PREVIEW_SCALE = 4 # Resolution divisor for previews rendered from scratch
+PREVIEW_LIMIT = 64 # Iteration limit for previews rendered from scratch
+PREVIEW_MAX_AGE = 10 # Seconds clients may cache a preview for
+RENDER_QUEUE = 'render' # Push queue for rendering tiles in the background
+RENDER_NAMESPACE = 'render' # Memcache namespace for queued renders
+RENDER_LOCK_TIME = 60 # Seconds before a missing tile may be queued again
+REPORT_SHARDS = 8 # Queries run at once when scanning all cached tiles
+
+
+class BackendRouter(object):
+  """Spreads stripe renders across the backends by their predicted cost.
+
+  Keeps track of the predicted cost of the requests this instance has in
+  flight on each backend, and sends each new request to the least loaded.
+  """
+
+  def __init__(self, num_backends):
+    self.load = [0] * num_backends
+    self.lock = threading.Lock()
+
+  def acquire(self, cost, exclude=()):
+    """Picks a backend instance, adding cost to its load.
+
+    Args:
+      cost: The predicted cost of the request.
+      exclude: Instances to avoid if possible, e.g. ones that just failed.
+    Returns:
+      The backend instance number.
+    """
+    with self.lock:
+      candidates = [instance for instance in range(len(self.load))
+                    if instance not in exclude] or range(len(self.load))
+      # Break ties randomly, so idle instances don't all pick the first one.
+      instance = min(candidates,
+                     key=lambda i: (self.load[i], random.random()))
+      self.load[instance] += cost
+      return instance
+
+  def release(self, instance, cost):
+    """Removes the cost of a finished request from a backend's load."""
+    with self.lock:
+      self.load[instance] -= cost
+
+router = BackendRouter(NUM_BACKENDS)
+
 
 class BaseHandler(webapp2.RequestHandler):
   @webapp2.cached_property
@@ -123,69 +189,330 @@ def render_image(x, y, width, height, px_width):
 def fetch_or_render_tile(level, x, y):
   logging.debug("Starting render of %r/%r/%r", level, x, y)
   tile_key = models.CachedTile.key_for_tile('exabrot', level, x, y)
-  tile = yield tile_key.get_async()
+  trace = tracing.Trace(level)
+  start_time = time.time()
+  with trace.span('datastore_get'):
+    tile = yield tile_key.get_async()
   img = None
   if not tile:
     logging.debug("Tile %r/%r/%r not in cache, fetching...", level, x, y)
-    tile, img = yield render_tile(level, x, y)
+    tile, img = yield render_tile(level, x, y, trace=trace)
+    with trace.span('datastore_put'):
+      yield tile.put_async()
+    # Only renders are traced; cache hits would swamp the histograms.
+    trace.add('total', time.time() - start_time)
+    trace.record()
+  elif tile.fingerprint != mandelbrot.FINGERPRINT:
+    # Keep serving the stale tile while it's re-rendered in the background.
+    note_stale_tile(level, x, y)
+  elif tile.iteration_limit < mandelbrot.choose_limit(level):
+    # Likewise while its iteration limit is raised.
+    note_shallow_tile(level, x, y, mandelbrot.choose_limit(level))
   raise tasklets.Return(tile, img)
 
 
+def note_stale_tile(level, x, y):
+  """Counts a request for a stale tile, queueing it for re-rendering."""
+  name = '%s-%d-%d-%d' % (mandelbrot.FINGERPRINT, level, x, y)
+  try:
+    hits = memcache.incr(name, initial_value=0,
+                         namespace=STALE_HITS_NAMESPACE)
+    if hits is None or hits == 1:
+      task = taskqueue.Task(name=name, method='PULL',
+                            payload='%d/%d/%d' % (level, x, y))
+      try:
+        taskqueue.Queue(RERENDER_QUEUE).add(task)
+      except (taskqueue.TaskAlreadyExistsError,
+              taskqueue.TombstonedTaskError):
+        pass
+  except Exception:
+    # The stale tile can still be served. Resetting the count lets the next
+    # request for it retry queueing the re-render.
+    logging.exception("Couldn't queue re-rendering tile %d/%d/%d", level, x, y)
+    memcache.delete(name, namespace=STALE_HITS_NAMESPACE)
+
+
+def note_shallow_tile(level, x, y, limit):
+  """Queues a tile whose iteration limit is too low to be deepened."""
+  name = 'deepen-%d-%d-%d-%d' % (level, x, y, limit)
+  if memcache.add(name, 1, time=DEEPEN_LOCK_TIME, namespace=DEEPEN_NAMESPACE):
+    try:
+      taskqueue.add(queue_name=DEEPEN_QUEUE, name=name, url='/tasks/deepen',
+                    params={'level': level, 'x': x, 'y': y, 'limit': limit})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      pass
+    except Exception:
+      # The cached tile can still be served. Let the next request for it
+      # retry queueing the deepen pass.
+      logging.exception("Couldn't queue deepening tile %d/%d/%d", level, x, y)
+      memcache.delete(name, namespace=DEEPEN_NAMESPACE)
+
+
+def queue_render(level, x, y):
+  """Queues a missing tile to be rendered in the background."""
+  name = '%d-%d-%d' % (level, x, y)
+  if memcache.add(name, 1, time=RENDER_LOCK_TIME, namespace=RENDER_NAMESPACE):
+    try:
+      taskqueue.add(queue_name=RENDER_QUEUE, url='/tasks/render',
+                    params={'level': level, 'x': x, 'y': y})
+    except Exception:
+      # The preview can still be served. Let the next request for the tile
+      # retry queueing the render.
+      logging.exception("Couldn't queue rendering tile %d/%d/%d", level, x, y)
+      memcache.delete(name, namespace=RENDER_NAMESPACE)
+
+
 @tasklets.tasklet
-def render_tile(level, x, y):
-  # Compute the bounds of this tile
+def preview_tile(level, x, y):
+  """Returns a cheap approximation of a tile that hasn't been rendered.
+
+  If the parent tile is cached, the part of it covering this tile is scaled
+  up; otherwise the tile is rendered at reduced resolution and iteration
+  limit, and scaled up.
+
+  Returns:
+    A PIL Image.
+  """
   xmin, ymin, xsize, ysize, tilesize = mandelbrot.calculate_bounds(
       level, x, y)
-  # Divide the tile up into vertical stripes
-  stripe_size = ysize / NUM_STRIPES
-  stripe_height = tilesize / NUM_STRIPES
-  stripes = [
-      (xmin, ymin + stripe_size * i, xsize, stripe_size, tilesize,
-       stripe_height) for i in range(NUM_STRIPES)]
+  parent = None
+  if level > 0:
+    parent_position = (level - 1, x // 2, y // 2)
+    parent = yield models.CachedTile.key_for_tile(
+        'exabrot', *parent_position).get_async()
+  if parent is not None:
+    pxmin, pymin, pxsize, pysize, psize = mandelbrot.calculate_bounds(
+        *parent_position)
+    box = [int(round(v * psize)) for v in (
+        (xmin - pxmin) / pxsize, (ymin - pymin) / pysize,
+        (xmin + xsize - pxmin) / pxsize, (ymin + ysize - pymin) / pysize)]
+    img = Image.open(blobstore.BlobReader(parent.tile)).convert('RGB')
+    img = img.crop(tuple(box))
+  else:
+    size = max(1, tilesize // PREVIEW_SCALE)
+    img = mandelbrot.render_tile(xmin, xsize, ymin, ysize, size, size,
+                                 PREVIEW_LIMIT).image()
+  raise tasklets.Return(img.resize((tilesize, tilesize), Image.BILINEAR))
+
+
+@tasklets.tasklet
+def replace_tile(level, x, y):
+  """Re-renders a stale tile and atomically swaps it into the cache."""
+  tile_key = models.CachedTile.key_for_tile('exabrot', level, x, y)
+  old = yield tile_key.get_async()
+  if old and old.fingerprint == mandelbrot.FINGERPRINT:
+    return
+  tile, img = yield render_tile(level, x, y)
+  yield swap_tile(
+      tile, lambda current: current.fingerprint == mandelbrot.FINGERPRINT)
+
+
+@tasklets.tasklet
+def deepen_tile(level, x, y, limit):
+  """Raises a cached tile's iteration limit, resuming from its saved orbits.
+
+  Only the pixels that hadn't escaped are iterated further, so this costs a
+  fraction of re-rendering the tile. Tiles without saved orbits are
+  re-rendered from scratch.
+  """
+  tile_key = models.CachedTile.key_for_tile('exabrot', level, x, y)
+  old = yield tile_key.get_async()
+  if old is None or old.iteration_limit >= limit:
+    return
+  if old.orbits is None or old.fingerprint != mandelbrot.FINGERPRINT:
+    tile, img = yield render_tile(level, x, y, limit)
+  else:
+    start_time = time.time()
+    state = mandelbrot.OrbitState.from_string(
+        blobstore.BlobReader(old.orbits).read())
+    pixels = numpy.array(
+        Image.open(blobstore.BlobReader(old.tile)).convert('RGB'))
+    stripes = mandelbrot.tile_stripes(level, x, y, NUM_STRIPES)
+    tilesize, stripe_height = stripes[0][4:6]
+    stripe_pixels = tilesize * stripe_height
+    parts = state.split(stripe_pixels, len(stripes))
+    operation_cost = old.operation_cost
+    late_escapes = 0
+    # Each stripe was rendered separately, with its own grid of points.
+    for stripe_num, (part, stripe) in enumerate(zip(parts, stripes)):
+      xmin, ymin, xsize, ysize, width, height = stripe
+      top = stripe_num * stripe_height
+      cost, late = mandelbrot.resume(
+          pixels[top:top + stripe_height], part, width, height, limit,
+          xmin, xsize, ymin, ysize, mandelbrot.ESCAPE)
+      operation_cost += cost
+      late_escapes += late
+    state = mandelbrot.OrbitState.concatenate(
+        parts, [i * stripe_pixels for i in range(len(parts))])
+    elapsed = time.time() - start_time
+    logging.info("Deepened tile %s/%s/%s from %d to %d iterations in %.2f "
+                 "seconds.", level, x, y, old.iteration_limit, limit, elapsed)
+    # The cost map is left as is: it predicts the cost of a full render well
+    # enough, and the extra iterations are all in the interior.
+    tile = write_tile(level, x, y, operation_cost, old.render_time + elapsed,
+                      Image.fromarray(pixels), limit,
+                      late_escapes / float(tilesize * tilesize), state,
+                      old.cost_map)
+  yield swap_tile(tile, lambda current: current.iteration_limit >= limit)
+
+
+@tasklets.tasklet
+def swap_tile(tile, is_current):
+  """Atomically replaces a cached tile, unless it's been replaced already.
+
+  Args:
+    tile: The new CachedTile.
+    is_current: A function that takes the currently cached tile and returns
+      True if it is already up to date, in which case tile is discarded.
+  """
+  @tasklets.tasklet
+  def txn():
+    old = yield tile.key.get_async()
+    if old and is_current(old):
+      # Someone else got there first; discard our copy.
+      raise tasklets.Return(tile, False)
+    yield tile.put_async()
+    raise tasklets.Return(old, True)
+  unused, replaced = yield model.transaction_async(txn)
+
+  if unused is not None:
+    # Requests already in flight may still be serving the old blobs.
+    blob_keys = [str(blob_key) for blob_key in (unused.tile, unused.orbits)
+                 if blob_key]
+    taskqueue.add(url='/tasks/delete_blob', params={'blob_key': blob_keys},
+                  countdown=BLOB_GRACE_PERIOD if replaced else 0)
+
+
+@tasklets.tasklet
+def render_tile(level, x, y, limit=None, trace=None):
+  """Renders a tile on the backends and writes it to the blobstore.
+
+  Args:
+    level, x, y: The tile's position.
+    limit: The iteration limit, or None to choose one.
+    trace: A tracing.Trace to add the time spent in each stage to.
+  Returns:
+    A (CachedTile, PIL Image) tuple. The CachedTile hasn't been put yet.
+  """
+  if trace is None:
+    trace = tracing.Trace(level)
+  if limit is None:
+    with trace.span('datastore_get'):
+      limit = yield choose_limit(level, x, y)
+  stripes = mandelbrot.tile_stripes(level, x, y, NUM_STRIPES)
+  tilesize, stripe_height = stripes[0][4:6]
+  with trace.span('datastore_get'):
+    cost_model = yield costmodel.load(level, x, y)
+  with trace.span('routing'):
+    predicted = (cost_model.predict_stripes(level, x, y, len(stripes)) or
+                 [DEFAULT_STRIPE_COST] * len(stripes))
+  stripes = [stripe + (limit, SAVE_ORBITS, cost, trace)
+             for stripe, cost in zip(stripes, predicted)]
+  # Start the most expensive stripes first, so no long one starts last.
+  order = sorted(range(len(stripes)), key=lambda i: -predicted[i])
 
   # Construct the image that will hold the final tile
   img = Image.new('RGB', (tilesize, tilesize))
   operation_cost = 0
+  late_escapes = 0
+  states = []
+  cost_map = []
   start_time = time.time()
 
-  map_result = yield ndb_map(get_image, stripes, PARALLELISM)
-  for stripe_num, (stripe, opcost) in enumerate(map_result):
+  map_result = yield ndb_map(get_image, [stripes[i] for i in order],
+                             PARALLELISM)
+  results = [None] * len(stripes)
+  for i, result in zip(order, map_result):
+    results[i] = result
+  for stripe_num, (stripe, opcost, late, costs, orbits) in enumerate(results):
     # Paste the result into the final image
     operation_cost += opcost
-    stripe_img = Image.open(cStringIO.StringIO(stripe))
-    img.paste(stripe_img, (0, stripe_num * stripe_height))
+    late_escapes += late
+    cost_map.append(costs)
+    with trace.span('png_decode'):
+      stripe_img = Image.open(cStringIO.StringIO(stripe))
+      stripe_img.load()
+    with trace.span('paste'):
+      img.paste(stripe_img, (0, stripe_num * stripe_height))
+    if orbits is not None:
+      states.append(mandelbrot.OrbitState.from_string(orbits))
   elapsed = time.time() - start_time
 
+  state = None
+  if states:
+    state = mandelbrot.OrbitState.concatenate(
+        states, [i * tilesize * stripe_height for i in range(len(states))])
+
   # Save the image to the datastore and return it
-  logging.info("Rendered tile %s/%s/%s in %.2f seconds with %d operations.",
-               level, x, y, elapsed, operation_cost)
+  logging.info("Rendered tile %s/%s/%s in %.2f seconds with %d operations "
+               "and an iteration limit of %d.",
+               level, x, y, elapsed, operation_cost, limit)
 
-  tile = write_tile(level, x, y, operation_cost, elapsed, img)
-  yield tile.put_async()
+  tile = write_tile(level, x, y, operation_cost, elapsed, img, limit,
+                    late_escapes / float(tilesize * tilesize), state,
+                    costmodel.pack_cost_map(numpy.array(cost_map)), trace)
   raise tasklets.Return(tile, img)
 
-def write_tile(level, x, y, operation_cost, elapsed, img):
-  """Writes a tile to the blobstore and returns the datastore object."""
-  tiledata = cStringIO.StringIO()
-  img.save(tiledata, 'PNG')
 
-  write_start = time.time()
-  tile_filename = files.blobstore.create(mime_type='image/png')
-  with files.open(tile_filename, 'a') as f:
-    f.write(tiledata.getvalue())
-  files.finalize(tile_filename)
-  logging.info("Blobstore write took %.2f seconds", time.time() - write_start)
+@tasklets.tasklet
+def choose_limit(level, x, y):
+  """Chooses a tile's iteration limit from its level and its parent tile."""
+  parent = None
+  if level > 0:
+    parent_key = models.CachedTile.key_for_tile('exabrot', level - 1,
+                                                x // 2, y // 2)
+    parent = yield parent_key.get_async()
+  if parent is None:
+    raise tasklets.Return(mandelbrot.choose_limit(level))
+  raise tasklets.Return(mandelbrot.choose_limit(
+      level, parent.iteration_limit, parent.late_escapes))
+
+
+def write_tile(level, x, y, operation_cost, elapsed, img, limit,
+               late_escapes, state=None, cost_map=None, trace=None):
+  """Writes a tile to the blobstore and returns the datastore object.
+
+  If state is an OrbitState with any live pixels, it is stored too. If trace
+  is a tracing.Trace, the time spent encoding and writing is added to it.
+  """
+  if trace is None:
+    trace = tracing.Trace(level)
+  with trace.span('png_encode'):
+    data = pngencoder.encode(img)
+  with trace.span('blobstore_write'):
+    tile_blob = write_blob(data, 'image/png')
+    orbits_blob = None
+    if state:
+      orbits_blob = write_blob(state.to_string(), 'application/octet-stream')
 
   return models.CachedTile(
       key=models.CachedTile.key_for_tile('exabrot', level, x, y),
-      tile=files.blobstore.get_blob_key(tile_filename),
+      tile=tile_blob,
+      orbits=orbits_blob,
       rendered=datetime.datetime.utcnow(),
       operation_cost=operation_cost,
       render_time=elapsed,
-      level=level)
+      level=level,
+      fingerprint=mandelbrot.FINGERPRINT,
+      iteration_limit=limit,
+      late_escapes=late_escapes,
+      cost_map=cost_map)
+
+
+def write_blob(data, mime_type):
+  """Writes data to the blobstore, returning its blob key."""
+  write_start = time.time()
+  filename = files.blobstore.create(mime_type=mime_type)
+  with files.open(filename, 'a') as f:
+    f.write(data)
+  files.finalize(filename)
+  logging.info("Blobstore write took %.2f seconds", time.time() - write_start)
+  return files.blobstore.get_blob_key(filename)
+
 
 @tasklets.tasklet
-def get_image(xmin, ymin, xsize, ysize, width, height):
+def get_image(xmin, ymin, xsize, ysize, width, height, limit, orbits=False,
+              predicted_cost=DEFAULT_STRIPE_COST, trace=None):
   params = urllib.urlencode({
       'xmin': xmin,
       'ymin': ymin,
@@ -193,51 +520,166 @@ def get_image(xmin, ymin, xsize, ysize, width, height):
       'ysize': ysize,
       'width': width,
       'height': height,
+      'limit': limit,
+      'orbits': int(orbits),
+      'antialias': mandelbrot.ANTIALIAS_BUDGET // NUM_STRIPES,
   })
+  if trace is None:
+    trace = tracing.Trace(None)
+  failed = []
   for i in range(3): # Retries
-    instance_id = hash(params) % NUM_BACKENDS
-    url = urlparse.urljoin(backends.get_url('renderer', instance=instance_id),
-                           '/backend/render_tile?%s' % params)
+    with trace.span('routing'):
+      instance_id = router.acquire(predicted_cost, exclude=failed)
+      url = urlparse.urljoin(
+          backends.get_url('renderer', instance=instance_id),
+          '/backend/render_tile?%s' % params)
     rpc = urlfetch.create_rpc(deadline=10.0)
     urlfetch.make_fetch_call(rpc, url)
     try:
-      response = yield rpc
+      with trace.span('backend_fetch'):
+        response = yield rpc
       if response.status_code not in (500, 0):
         break
     except (apiproxy_errors.DeadlineExceededError,
             urlfetch.DeadlineExceededError):
       pass
+    finally:
+      router.release(instance_id, predicted_cost)
+    failed.append(instance_id)
     logging.warn("Backend failed to render tile; retrying")
     # Wait a little before retrying
     time.sleep(0.2)
   assert response.status_code == 200, \
       "Expected status 200, got %s" % response.status_code
+  trace.add('backend_kernel', float(response.headers['X-Render-Time']))
+  trace.add('backend_encode', float(response.headers['X-Encode-Time']))
+  content = response.content
+  state = None
+  if orbits:
+    # The backend appends the orbit state after the image.
+    split = len(content) - int(response.headers['X-Orbits-Length'])
+    content, state = content[:split], content[split:]
   raise tasklets.Return(
-      response.content,
-      int(response.headers['X-Operation-Cost']))
+      content,
+      int(response.headers['X-Operation-Cost']),
+      int(response.headers['X-Late-Escapes']),
+      [int(cost) for cost in response.headers['X-Cost-Map'].split(',')],
+      state)
 
 
 class TileHandler(BaseHandler):
   @context.toplevel
   def get(self, level, x, y):
+    level, x, y = int(level), int(x), int(y)
     self.response.headers['Content-Type'] = 'image/png'
-    tile, img = yield fetch_or_render_tile(int(level), int(x), int(y))
+    if PROGRESSIVE:
+      tile_key = models.CachedTile.key_for_tile('exabrot', level, x, y)
+      tile = yield tile_key.get_async()
+      if tile is None:
+        # Serve a preview now; the full tile replaces it on a later request.
+        queue_render(level, x, y)
+        img = yield preview_tile(level, x, y)
+        self.response.headers['Cache-Control'] = (
+            'public, max-age=%d' % PREVIEW_MAX_AGE)
+        self.response.write(pngencoder.encode(img))
+        return
+    tile, img = yield fetch_or_render_tile(level, x, y)
     self.response.headers['X-AppEngine-BlobKey'] = str(tile.tile)
 
 
+class RenderTaskHandler(BaseHandler):
+  """Renders a missing tile. Run from the render task queue."""
+  @context.toplevel
+  def post(self):
+    level, x, y = (int(self.request.get(arg)) for arg in ('level', 'x', 'y'))
+    yield fetch_or_render_tile(level, x, y)
+
+
 class RenderHandler(BaseHandler):
   @context.toplevel
   def get(self, x, y, width, height):
     x, y, width, height = [float(z) for z in (x, y, width, height)]
     image = yield render_image(x, y, width, height, 512)
-    image_data = cStringIO.StringIO()
-    image.save(image_data, 'PNG')
     self.response.headers['Content-Type'] = 'image/png'
-    self.response.write(image_data.getvalue())
+    self.response.write(pngencoder.encode(image))
+
+
+class RerenderHandler(BaseHandler):
+  """Re-renders the most requested stale tiles. Run periodically by cron."""
+  @context.toplevel
+  def get(self):
+    queue = taskqueue.Queue(RERENDER_QUEUE)
+    tasks = queue.lease_tasks(RERENDER_LEASE, RERENDER_SCAN)
+    if not tasks:
+      return
+    # Hottest first; the rest are picked up again once their lease expires.
+    hits = memcache.get_multi([task.name for task in tasks],
+                              namespace=STALE_HITS_NAMESPACE)
+    tasks.sort(key=lambda task: hits.get(task.name, 0), reverse=True)
+    batch = tasks[:RERENDER_BATCH]
+    positions = [tuple(int(v) for v in task.payload.split('/'))
+                 for task in batch]
+    yield ndb_map(replace_tile, positions, RERENDER_PARALLELISM)
+    queue.delete_tasks(batch)
+    memcache.delete_multi([task.name for task in batch],
+                          namespace=STALE_HITS_NAMESPACE)
+    logging.info("Re-rendered %d of %d stale tiles.", len(batch), len(tasks))
+
+
+class DeepenHandler(BaseHandler):
+  """Raises a tile's iteration limit. Run from the deepen task queue."""
+  @context.toplevel
+  def post(self):
+    level, x, y, limit = (int(self.request.get(arg))
+                          for arg in ('level', 'x', 'y', 'limit'))
+    yield deepen_tile(level, x, y, limit)
+
+
+class CostReportHandler(BaseHandler):
+  """Reports how well the cost model predicts cached tiles' costs."""
+  @context.toplevel
+  def get(self):
+    # Only a few fields are read, so leave the rest undecoded.
+    tiles = yield models.CachedTile.query().map_parallel_async(
+        lambda tile: tile, shards=REPORT_SHARDS, lazy=True)
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.response.write('%5s %8s %12s %12s\n' % (
+        'level', 'tiles', 'mean error', 'median error'))
+    for level, count, mean, median in costmodel.error_report(tiles):
+      self.response.write('%5d %8d %11.1f%% %11.1f%%\n' % (
+          level, count, mean * 100, median * 100))
+
+
+class TraceReportHandler(BaseHandler):
+  """Reports per-level latency percentiles for each stage of rendering."""
+  def get(self):
+    histograms = tracing.histograms()
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.response.write('%5s %-16s %8s %10s %8s %8s %8s\n' % (
+        'level', 'stage', 'tiles', 'mean ms', 'p50', 'p90', 'p99'))
+    for level, stage in sorted(histograms,
+                               key=lambda k: (k[0], tracing.STAGES.index(k[1]))):
+      counts, total = histograms[(level, stage)]
+      self.response.write('%5d %-16s %8d %10.1f %8s %8s %8s\n' % (
+          (level, stage, sum(counts), total / float(sum(counts))) +
+          tuple('<%s' % bound if bound is not None else 'more'
+                for bound in (tracing.percentile(counts, fraction)
+                              for fraction in (0.5, 0.9, 0.99)))))
+
+
+class DeleteBlobHandler(BaseHandler):
+  def post(self):
+    blobstore.delete(self.request.get_all('blob_key'))
 
 
 application = webapp2.WSGIApplication([
     ('/', IndexHandler),
     ('/render/([0-9.e-]+)_([0-9.e-]+)_([0-9.e-]+)_([0-9.e-]+)\.png', RenderHandler),
     ('/exabrot_files/(\d+)/(\d+)_(\d+).png', TileHandler),
+    ('/tasks/render', RenderTaskHandler),
+    ('/tasks/rerender', RerenderHandler),
+    ('/tasks/deepen', DeepenHandler),
+    ('/tasks/cost_report', CostReportHandler),
+    ('/tasks/trace_report', TraceReportHandler),
+    ('/tasks/delete_blob', DeleteBlobHandler),
 ], debug=True)
\ No newline at end of file
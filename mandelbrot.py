@@ -1,14 +1,22 @@
 import colorsys
+import hashlib
 import itertools
 import logging
 import numpy
+import struct
 import time
+import zlib
 from concurrent import futures
 from PIL import Image
 
 TILE_SIZE_BITS = 8
 TILE_SIZE = 1 << TILE_SIZE_BITS # Length of a side of a tile
-LIMIT = 256   # Max mandelbrot iterations
+LIMIT = 256   # Default max mandelbrot iterations
+MIN_LIMIT = 64 # Iteration limit for level 0
+MAX_LIMIT = 16384 # Highest iteration limit a tile may be given
+LIMIT_DOUBLING_LEVELS = 6 # Levels over which the iteration limit doubles
+LATE_FRACTION = 0.25 # Final fraction of iterations counted as "late"
+LATE_ESCAPE_THRESHOLD = 0.002 # Late escapes above which children get more
 ESCAPE = 4.0  # Value at which a cell is said to have escaped
 PALETTE_SIZE = 1024 # Number of elements in palette
 PALETTE_STEP = 15.0 # Rate to step through the palette
@@ -16,8 +24,21 @@ XMIN = -2.0 # Xmin for entire set
 XMAX = 1.0 # Xmax for entire set
 YMIN = -1.5 # Ymin for entire set
 YMAX = 1.5 # Ymax for entire set
+ANTIALIAS_BUDGET = 0 # Supersamples per tile for antialiasing; 0 disables
+ANTIALIAS_GRID = 2 # Side of the grid of supersamples taken per pixel
+ANTIALIAS_THRESHOLD = 2 # Iteration count difference that marks an edge
+MODE_ESCAPE = 'escape' # Colour pixels by smoothed escape iteration
+MODE_DISTANCE = 'distance' # Shade pixels by distance to the set's boundary
+MODES = (MODE_ESCAPE, MODE_DISTANCE)
+DISTANCE_ESCAPE = 1000.0 # Escape radius for accurate distance estimates
+DISTANCE_SATURATION = 4.0 # Distance, in pixels, shaded as fully exterior
+DISTANCE_BLOCK = 16 # Side of the blocks tested for skipping in distance mode
+DISTANCE_BOUND = 4.0 # Most the true distance can exceed its estimate by
+CHUNK_BUDGET = 64 << 20 # Bytes of working memory for chunked renders
+BYTES_PER_PIXEL = 128 # Approximate working memory iterate() needs per pixel
 NUM_THREADS = 1
 NUM_STRIPES = 1
+ENGINE_VERSION = 1 # Bump whenever a kernel change alters rendered output
 
 def interpolate_palette(points, pos):
   # Find the two points that we're interpolating between
@@ -60,6 +81,24 @@ palette = numpy.array([
     for i in range(PALETTE_SIZE)])
 
 
+def render_fingerprint():
+  """Returns a short string identifying the current render parameters.
+
+  Tiles rendered with a different fingerprint are stale and should be
+  re-rendered. Iteration limits are recorded per tile, and can be raised
+  without re-rendering, so they are not part of the fingerprint.
+  """
+  params = (ENGINE_VERSION, ESCAPE, PALETTE_SIZE, PALETTE_STEP, XMIN, XMAX,
+            YMIN, YMAX, TILE_SIZE_BITS)
+  if ANTIALIAS_BUDGET:
+    params += (ANTIALIAS_BUDGET, ANTIALIAS_GRID, ANTIALIAS_THRESHOLD)
+  params = hashlib.sha1(repr(params))
+  params.update(palette.astype(numpy.uint8).tostring())
+  return params.hexdigest()[:12]
+
+FINGERPRINT = render_fingerprint()
+
+
 def calculate_bounds(level, x, y):
   tile_level = max(level - TILE_SIZE_BITS, 0) # First n levels are sub-tile sized
   tilesize = 1 << min(TILE_SIZE_BITS, level)
@@ -73,16 +112,648 @@ def calculate_bounds(level, x, y):
   ymin = YMIN + ysize * y
   
   return xmin, ymin, xsize, ysize, tilesize
-  
 
-def render_tile(xmin, xsize, ymin, ysize, width, height):
-  """Render a mandelbrot set image with the specified parameters."""
-  logging.info("Generating image with w=%d, h=%d, xmin = %f, ymin = %f, xsize = %f, ysize = %f",
-               width, height, xmin, ymin, xsize, ysize)
 
-  img, opcount = mandelbrot(width, height, LIMIT, xmin, xsize, ymin, ysize,
-                            ESCAPE)
-  return Image.fromarray(img), opcount
+def tile_stripes(level, x, y, num_stripes):
+  """Divides a tile up into horizontal stripes, rendered separately.
+
+  Returns:
+    A list of (xmin, ymin, xsize, ysize, width, height) tuples, one for
+    each stripe from top to bottom.
+  """
+  xmin, ymin, xsize, ysize, tilesize = calculate_bounds(level, x, y)
+  stripe_size = ysize / num_stripes
+  stripe_height = tilesize / num_stripes
+  return [
+      (xmin, ymin + stripe_size * i, xsize, stripe_size, tilesize,
+       stripe_height) for i in range(num_stripes)]
+
+
+def choose_limit(level, parent_limit=None, parent_late_escapes=None):
+  """Picks the iteration limit for a tile.
+
+  The limit grows geometrically with the level, and is doubled relative to
+  the parent tile's limit if a significant fraction of the parent's pixels
+  only escaped near that limit, since that means detail is being lost.
+
+  Args:
+    level: The level of the tile being rendered.
+    parent_limit: The iteration limit of the parent tile, if known.
+    parent_late_escapes: The fraction of the parent tile's pixels that
+      escaped in the last LATE_FRACTION of its iterations, if known.
+  Returns:
+    The iteration limit to use.
+  """
+  limit = MIN_LIMIT * 2 ** (float(level) / LIMIT_DOUBLING_LEVELS)
+  if parent_limit:
+    if (parent_late_escapes is not None and
+        parent_late_escapes > LATE_ESCAPE_THRESHOLD):
+      parent_limit *= 2
+    limit = max(limit, parent_limit)
+  return int(min(limit, MAX_LIMIT))
+
+
+def render_tile(xmin, xsize, ymin, ysize, width, height, limit=LIMIT,
+                antialias=0, mode=MODE_ESCAPE):
+  """Render a mandelbrot set image with the specified parameters.
+
+  Args:
+    antialias: The number of supersamples to spend antialiasing edges.
+      Only used in MODE_ESCAPE.
+    mode: One of MODES.
+  Returns:
+    A Render.
+  """
+  logging.info("Generating image with w=%d, h=%d, xmin = %f, ymin = %f, xsize = %f, ysize = %f, limit = %d, mode = %s",
+               width, height, xmin, ymin, xsize, ysize, limit, mode)
+
+  if mode == MODE_DISTANCE:
+    return render_distance(width, height, limit, xmin, xsize, ymin, ysize,
+                           DISTANCE_ESCAPE)
+  elif mode != MODE_ESCAPE:
+    raise ValueError('Unknown render mode %r' % (mode,))
+
+  result = render(width, height, limit, xmin, xsize, ymin, ysize, ESCAPE)
+  if antialias:
+    result.cost += supersample_edges(
+        result, width, height, limit, xmin, xsize, ymin, ysize, ESCAPE,
+        antialias)
+  return result
+
+
+def find_edges(counts, threshold=ANTIALIAS_THRESHOLD):
+  """Finds pixels whose iteration count differs sharply from a neighbour's.
+
+  Args:
+    counts: A (height, width) array of iteration counts.
+    threshold: The smallest difference that counts as an edge.
+  Returns:
+    A (height, width) array of the largest difference between each pixel
+    and its four neighbours, zeroed where it's below threshold.
+  """
+  counts = counts.astype(numpy.int32)
+  contrast = numpy.zeros(counts.shape, dtype=numpy.int32)
+  vertical = numpy.abs(counts[1:] - counts[:-1])
+  horizontal = numpy.abs(counts[:, 1:] - counts[:, :-1])
+  numpy.maximum(contrast[1:], vertical, contrast[1:])
+  numpy.maximum(contrast[:-1], vertical, contrast[:-1])
+  numpy.maximum(contrast[:, 1:], horizontal, contrast[:, 1:])
+  numpy.maximum(contrast[:, :-1], horizontal, contrast[:, :-1])
+  contrast[contrast < threshold] = 0
+  return contrast
+
+
+def supersample_edges(result, width, height, itermax, xmin, xsize, ymin,
+                      ysize, escape, budget, grid_size=ANTIALIAS_GRID):
+  """Antialiases a render by supersampling only the pixels on edges.
+
+  The pixels with the highest contrast against their neighbours are each
+  replaced by the average of a grid of samples across the pixel, until the
+  sample budget is used up.
+
+  Args:
+    result: The Render to antialias, updated in place.
+    width, height, itermax, xmin, xsize, ymin, ysize, escape: As for
+      mandelbrot().
+    budget: The maximum number of samples to take.
+    grid_size: The side of the grid of samples taken for each pixel.
+  Returns:
+    The cost of the extra iterations.
+  """
+  samples = grid_size * grid_size
+  contrast = find_edges(result.counts).reshape(-1)
+  edges = numpy.flatnonzero(contrast)
+  if len(edges) * samples > budget:
+    # Keep the sharpest edges that fit in the budget.
+    keep = numpy.argsort(contrast[edges])[len(edges) - budget // samples:]
+    edges = numpy.sort(edges[keep])
+  if not len(edges):
+    return 0
+
+  # Offsets of the samples within a pixel, in units of the pixel pitch.
+  offsets = (numpy.arange(grid_size) + 0.5) / grid_size - 0.5
+  xstep = xsize / max(width - 1, 1)
+  ystep = ysize / max(height - 1, 1)
+  dx = numpy.tile(offsets, grid_size) * xstep
+  dy = numpy.repeat(offsets, grid_size) * ystep
+  centres = grid(width, height, xmin, xsize, ymin, ysize, edges)
+  c = (centres[:, numpy.newaxis] + dx + complex(0, 1) * dy).reshape(-1)
+
+  sample_pixels = numpy.zeros((len(c), 1, 3), dtype=numpy.uint8)
+  state = OrbitState(numpy.arange(len(c)), numpy.copy(c), 0)
+  cost, late = iterate(sample_pixels, c, state, itermax, escape)
+  averages = sample_pixels.reshape(len(edges), samples, 3).mean(axis=1)
+  result.pixels.reshape(-1, 3)[edges] = averages.round().astype(numpy.uint8)
+  return cost
+
+
+def estimate_distances(c, itermax, escape):
+  """Estimates the distance from each point to the mandelbrot set.
+
+  Iterates dz/dc alongside z, and uses the Koebe quarter theorem estimate
+  |z| log|z| / 2|dz/dc|, which is a lower bound on the true distance. The
+  same theorem bounds the true distance above by DISTANCE_BOUND times the
+  estimate, for points near the set.
+
+  Args:
+    c: A 1-dimensional array of points in the complex plane.
+    itermax: The maximum number of iterations.
+    escape: The escape radius; larger values give better estimates.
+  Returns:
+    A (distances, counts, cost) tuple, where distances is 0 for points that
+    didn't escape, and counts holds the iterations each point took.
+  """
+  distances = numpy.zeros(len(c))
+  counts = numpy.empty(len(c), dtype=numpy.int32)
+  counts.fill(itermax)
+  index = numpy.arange(len(c))
+  z = numpy.copy(c)
+  dz = numpy.ones(len(c), dtype=complex)
+  cost = 0
+  for i in xrange(itermax):
+    if not len(z):
+      break
+    cost += len(z)
+    dz *= z
+    dz *= 2
+    dz += 1
+    numpy.multiply(z, z, z)
+    numpy.add(z, c, z)
+    rem = abs(z) > escape
+
+    zabs = abs(z[rem])
+    distances[index[rem]] = 0.5 * zabs * numpy.log(zabs) / abs(dz[rem])
+    counts[index[rem]] = i + 1
+
+    rem = ~rem
+    z = z[rem]
+    dz = dz[rem]
+    index = index[rem]
+    c = c[rem]
+  return distances, counts, cost
+
+
+def render_distance(width, height, itermax, xmin, xsize, ymin, ysize, escape,
+                    block=DISTANCE_BLOCK):
+  """Renders an image shaded by distance to the set's boundary.
+
+  Pixels are dark near the boundary, fading to white DISTANCE_SATURATION
+  pixels away, and black inside the set. The centre of each block of
+  pixels is estimated first; blocks whose centre is too far from the set
+  for any of their pixels to be shaded aren't iterated at all.
+
+  A pixel is white when its own estimate is at least the saturation
+  distance. Its true distance is at least the centre's estimate less the
+  block's radius, and its estimate at least 1 / DISTANCE_BOUND of its true
+  distance, so a block is skipped only when the centre's estimate exceeds
+  the radius plus DISTANCE_BOUND times the saturation distance. The upper
+  Koebe bound holds in the limit of a large escape radius, so this is exact
+  up to the estimate's own error; benchmark.py distance checks it against
+  block=1.
+
+  Returns:
+    A Render. Its state is None, since distance renders can't be resumed.
+  """
+  xstep = xsize / max(width - 1, 1)
+  ystep = ysize / max(height - 1, 1)
+  saturation = DISTANCE_SATURATION * max(xstep, ystep)
+
+  # Estimate the distance at the centre of each block.
+  xstarts = numpy.arange(0, width, block)
+  ystarts = numpy.arange(0, height, block)
+  xcentres = (xstarts + numpy.minimum(xstarts + block, width) - 1) / 2.0
+  ycentres = (ystarts + numpy.minimum(ystarts + block, height) - 1) / 2.0
+  centres = ((xmin + xcentres * xstep)[numpy.newaxis, :] +
+             complex(0, 1) * (ymin + ycentres * ystep)[:, numpy.newaxis])
+  centre_distances, _, cost = estimate_distances(centres.reshape(-1),
+                                                 itermax, escape)
+  # Every pixel in a block lies within this distance of its centre.
+  radius = (block - 1) / 2.0 * numpy.hypot(xstep, ystep)
+  far = (centre_distances > radius + DISTANCE_BOUND * saturation).reshape(centres.shape)
+  far = far.repeat(block, axis=0).repeat(block, axis=1)[:height, :width]
+
+  # Estimate the distance at every pixel in the remaining blocks.
+  distances = numpy.empty(width * height)
+  distances.fill(numpy.inf)
+  counts = numpy.zeros(width * height, dtype=numpy.int32)
+  index = numpy.flatnonzero(~far)
+  c = grid(width, height, xmin, xsize, ymin, ysize, index)
+  distances[index], counts[index], pixel_cost = estimate_distances(
+      c, itermax, escape)
+  cost += pixel_cost
+
+  shade = numpy.sqrt(numpy.minimum(distances / saturation, 1.0))
+  pixels = numpy.empty((height, width, 3), dtype=numpy.uint8)
+  pixels[:] = (shade * 255).astype(numpy.uint8).reshape(height, width, 1)
+  return Render(pixels, cost, 0, None, counts.reshape(height, width))
+
+
+class Render(object):
+  """The result of rendering an image."""
+
+  def __init__(self, pixels, cost, late_escapes, state, counts):
+    self.pixels = pixels # (height, width, 3) RGB array
+    self.cost = cost # Total number of iterations computed
+    # Number of pixels that escaped in the last LATE_FRACTION of iterations
+    self.late_escapes = late_escapes
+    self.state = state # OrbitState of the pixels that never escaped, if any
+    self.counts = counts # (height, width) iterations each pixel took
+
+  def image(self):
+    """Returns the rendered image as a PIL Image."""
+    return Image.fromarray(self.pixels)
+
+  def cost_map(self, columns):
+    """Returns the cost of each of a row of equal-width vertical strips.
+
+    Args:
+      columns: The number of strips; reduced to the image width if larger.
+    Returns:
+      A 1-dimensional integer array of iteration counts.
+    """
+    height, width = self.counts.shape
+    columns = min(columns, width)
+    strips = self.counts.reshape(height, columns, width // columns)
+    return strips.sum(axis=2).sum(axis=0)
+
+
+class OrbitState(object):
+  """The orbits of the pixels of an image that have not escaped yet.
+
+  All live pixels are iterated in lockstep, so they share an iteration count.
+  """
+
+  def __init__(self, index, z, iterations):
+    self.index = index # Flattened (y * width + x) positions of live pixels
+    self.z = z # Current value of each live pixel's orbit
+    self.iterations = iterations # Iterations completed so far
+
+  def __len__(self):
+    return len(self.index)
+
+  def to_string(self):
+    """Serializes the state compactly, for storing alongside a tile.
+
+    Positions are sorted, so they are stored as deltas, which compress well.
+    """
+    deltas = numpy.diff(numpy.concatenate(([0], self.index)))
+    header = struct.pack('<II', self.iterations, len(self.index))
+    return zlib.compress(header + deltas.astype('<u4').tostring() +
+                         self.z.astype('<c16').tostring())
+
+  @classmethod
+  def from_string(cls, data):
+    """Deserializes a state serialized with to_string()."""
+    data = zlib.decompress(data)
+    iterations, count = struct.unpack_from('<II', data)
+    offset = struct.calcsize('<II')
+    deltas = numpy.frombuffer(data, '<u4', count, offset)
+    z = numpy.frombuffer(data, '<c16', count, offset + deltas.nbytes)
+    return cls(numpy.cumsum(deltas).astype(numpy.int64),
+               z.astype(complex), iterations)
+
+  @classmethod
+  def concatenate(cls, states, offsets):
+    """Combines the states of several parts of an image into one.
+
+    Args:
+      states: A list of OrbitStates, all at the same iteration count.
+      offsets: The flattened position of the first pixel of each part.
+    Returns:
+      An OrbitState for the whole image.
+    """
+    assert len(set(state.iterations for state in states)) <= 1
+    return cls(
+        numpy.concatenate([state.index + offset
+                           for state, offset in zip(states, offsets)]),
+        numpy.concatenate([state.z for state in states]),
+        states[0].iterations if states else 0)
+
+  def split(self, part_size, num_parts):
+    """Splits the state into equal-sized parts; the inverse of concatenate.
+
+    Args:
+      part_size: The number of pixels in each part.
+      num_parts: The number of parts.
+    Returns:
+      A list of OrbitStates, with positions relative to the start of each part.
+    """
+    bounds = numpy.searchsorted(self.index,
+                                numpy.arange(num_parts + 1) * part_size)
+    return [OrbitState(self.index[start:end] - i * part_size,
+                       self.z[start:end], self.iterations)
+            for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]))]
+
+
+def grid(width, height, xmin, xsize, ymin, ysize, index=None):
+  """Returns the points c in the complex plane for pixels of an image.
+
+  Args:
+    width, height, xmin, xsize, ymin, ysize: As for mandelbrot().
+    index: Flattened pixel positions to return points for. Defaults to all.
+  Returns:
+    A 1-dimensional complex array.
+  """
+  if index is None:
+    index = numpy.arange(width * height)
+  x = numpy.linspace(xmin, xmin + xsize, width)
+  y = numpy.linspace(ymin, ymin + ysize, height)
+  return x[index % width] + complex(0, 1) * y[index // width]
+
+
+def iterate(img, c, state, itermax, escape, counts=None, profiler=None):
+  """Iterates live pixels until they escape or reach the iteration limit.
+
+  Escaped pixels are coloured in img, and state is updated in place to hold
+  only the pixels that are still live.
+
+  The real and imaginary parts are kept in separate arrays, so that x*x and
+  y*y are computed once per iteration and shared between the escape test,
+  which compares |z|^2 with escape^2 rather than taking a square root, and
+  the next update. The smooth colour is only computed for escaped pixels.
+
+  Args:
+    img: The (height, width, 3) image being rendered.
+    c: The points in the complex plane for each pixel in state.
+    state: An OrbitState holding the live pixels.
+    itermax: The total number of iterations to stop at.
+    escape: The value at which a cell is said to have escaped.
+    counts: An optional (height, width) array, updated with the number of
+      iterations each pixel took (itermax for those still live).
+    profiler: An optional KernelProfiler, told when each phase of each
+      iteration ends.
+  Returns:
+    A (cost, late_escapes) tuple.
+  """
+  pixels = img.reshape(-1, 3)
+  if counts is not None:
+    counts = counts.reshape(-1)
+  index = state.index
+  x, y = numpy.copy(state.z.real), numpy.copy(state.z.imag)
+  cx, cy = numpy.copy(c.real), numpy.copy(c.imag)
+  xx, yy = x * x, y * y
+  escape_squared = escape * escape
+  late_start = itermax - int(itermax * LATE_FRACTION)
+  cost = 0
+  late = 0
+  for i in xrange(state.iterations, itermax):
+    if not len(x):
+      break
+    cost += len(x)
+    if profiler is not None:
+      profiler.start(len(x))
+    # z = z*z + c, computed exactly as numpy's complex multiply does.
+    y *= x
+    y *= 2
+    y += cy
+    numpy.subtract(xx, yy, x)
+    x += cx
+    numpy.multiply(x, x, xx)
+    numpy.multiply(y, y, yy)
+    if profiler is not None:
+      profiler.end('arithmetic')
+    magnitude = xx + yy
+    rem = magnitude > escape_squared
+
+    escaped = numpy.flatnonzero(rem)
+    if profiler is not None:
+      profiler.end('escape_test',
+                   magnitude.nbytes + rem.nbytes + escaped.nbytes)
+    if len(escaped):
+      # log|z| = log(|z|^2) / 2
+      smooth_index = i + 1 - numpy.log2(0.5 * numpy.log(magnitude[escaped]))
+      smooth_index *= PALETTE_STEP
+      smooth_index %= PALETTE_SIZE
+      pixels[index[escaped]] = palette[smooth_index.astype(int)]
+      if counts is not None:
+        counts[index[escaped]] = i + 1
+      if i >= late_start:
+        late += len(escaped)
+      if profiler is not None:
+        # magnitude[escaped], its log, log2 and the palette lookup.
+        profiler.end('colouring',
+                     4 * smooth_index.nbytes + len(escaped) * 3)
+
+      rem = ~rem
+      x = x[rem]
+      y = y[rem]
+      xx = xx[rem]
+      yy = yy[rem]
+      cx = cx[rem]
+      cy = cy[rem]
+      index = index[rem]
+      if profiler is not None:
+        profiler.end('compaction', rem.nbytes + 7 * x.nbytes)
+  if counts is not None:
+    counts[index] = itermax
+  state.index = index
+  state.z = (x + complex(0, 1) * y).astype(state.z.dtype)
+  state.iterations = max(state.iterations, itermax)
+  return cost, late
+
+
+def render(width, height, itermax, xmin, xsize, ymin, ysize, escape):
+  """Like mandelbrot(), but returns a Render with the state of the image.
+
+  The Render's state can be passed to resume() to continue iterating with a
+  higher limit.
+  """
+  c = grid(width, height, xmin, xsize, ymin, ysize)
+  img = numpy.zeros((height, width, 3), dtype=numpy.uint8)
+  counts = numpy.zeros((height, width), dtype=numpy.int32)
+  state = OrbitState(numpy.arange(width * height), numpy.copy(c), 0)
+  cost, late = iterate(img, c, state, itermax, escape, counts)
+  return Render(img, cost, late, state, counts)
+
+
+def render_batch(rects, itermax, escape):
+  """Renders several images with a single set of array operations.
+
+  Setting up and iterating many small images separately is dominated by
+  per-call overhead, so the pixels of all of them are flattened into one
+  array, iterated together, and scattered back into one Render per image.
+
+  Args:
+    rects: A list of (xmin, ymin, xsize, ysize, width, height) tuples, as
+      returned by tile_stripes().
+    itermax: The maximum number of iterations, shared by every image.
+    escape: The value at which a cell is said to have escaped.
+  Returns:
+    A list of Renders, one per rect.
+  """
+  if not rects:
+    return []
+  sizes = [width * height for xmin, ymin, xsize, ysize, width, height in rects]
+  offsets = numpy.concatenate(([0], numpy.cumsum(sizes)))
+  c = numpy.concatenate([
+      grid(width, height, xmin, xsize, ymin, ysize)
+      for xmin, ymin, xsize, ysize, width, height in rects])
+  img = numpy.zeros((len(c), 3), dtype=numpy.uint8)
+  counts = numpy.zeros(len(c), dtype=numpy.int32)
+  state = OrbitState(numpy.arange(len(c)), numpy.copy(c), 0)
+  iterate(img, c, state, itermax, escape, counts)
+
+  # Late escapes are counted as iterate() counts them: escaped pixels whose
+  # count is past late_start. Live pixels never escaped, so are excluded.
+  late_start = itermax - int(itermax * LATE_FRACTION)
+  late_escapes = counts > late_start
+  late_escapes[state.index] = False
+  bounds = numpy.searchsorted(state.index, offsets)
+  results = []
+  for i, (xmin, ymin, xsize, ysize, width, height) in enumerate(rects):
+    start, end = offsets[i], offsets[i + 1]
+    part = OrbitState(state.index[bounds[i]:bounds[i + 1]] - start,
+                      state.z[bounds[i]:bounds[i + 1]], state.iterations)
+    part_counts = counts[start:end]
+    # Each pixel costs one operation per iteration it took, and live pixels
+    # are counted as having taken itermax.
+    cost = int(part_counts.sum())
+    late = int(late_escapes[start:end].sum())
+    results.append(Render(img[start:end].reshape(height, width, 3), cost,
+                          late, part, part_counts.reshape(height, width)))
+  return results
+
+
+def render_rows(width, height, itermax, xmin, xsize, ymin, ysize, escape,
+                budget=CHUNK_BUDGET):
+  """Renders an image in blocks of rows, so memory use is bounded.
+
+  Each block is rendered from the same grid of points as render() would use
+  for the whole image, so the concatenated blocks are identical to it.
+
+  Args:
+    width, height, itermax, xmin, xsize, ymin, ysize, escape: As for
+      mandelbrot().
+    budget: The approximate number of bytes of working memory to use.
+  Yields:
+    (top, pixels, cost) tuples, where top is the first row of the block and
+    pixels is a (rows, width, 3) array.
+  """
+  rows = max(1, budget // (BYTES_PER_PIXEL * width))
+  for top in xrange(0, height, rows):
+    bottom = min(top + rows, height)
+    c = grid(width, height, xmin, xsize, ymin, ysize,
+             numpy.arange(top * width, bottom * width))
+    img = numpy.zeros((bottom - top, width, 3), dtype=numpy.uint8)
+    state = OrbitState(numpy.arange(len(c)), numpy.copy(c), 0)
+    cost, late = iterate(img, c, state, itermax, escape)
+    yield top, img, cost
+
+
+def render_large(out, itermax, xmin, xsize, ymin, ysize, escape,
+                 budget=CHUNK_BUDGET):
+  """Renders an image into out, block by block.
+
+  Args:
+    out: A (height, width, 3) uint8 array to write to, such as a
+      numpy.memmap, so that the whole image need never be in memory.
+    itermax, xmin, xsize, ymin, ysize, escape: As for mandelbrot().
+    budget: As for render_rows().
+  Returns:
+    The operation cost of the render.
+  """
+  height, width = out.shape[:2]
+  total = 0
+  for top, pixels, cost in render_rows(width, height, itermax, xmin, xsize,
+                                       ymin, ysize, escape, budget):
+    out[top:top + len(pixels)] = pixels
+    total += cost
+  return total
+
+
+class KernelProfiler(object):
+  """Records where iterate() spends its time, iteration by iteration.
+
+  iterate() calls start() at the beginning of each iteration, then end()
+  as each phase of it finishes, with the bytes of the arrays that phase
+  allocated. Those byte counts are estimated from the arrays' sizes, not
+  measured.
+  """
+
+  PHASES = ('arithmetic', 'escape_test', 'colouring', 'compaction')
+
+  def __init__(self):
+    self.phases = dict.fromkeys(self.PHASES, 0.0) # Seconds in each phase
+    self.occupancy = [] # Live pixels at the start of each iteration
+    self.estimated_allocations = [] # Bytes allocated in each iteration
+    self.compaction_times = [] # Seconds compacting in each iteration
+    self.last = None
+
+  def start(self, live):
+    self.occupancy.append(live)
+    self.estimated_allocations.append(0)
+    self.compaction_times.append(0.0)
+    self.last = time.time()
+
+  def end(self, phase, allocated=0):
+    now = time.time()
+    self.phases[phase] += now - self.last
+    self.estimated_allocations[-1] += allocated
+    if phase == 'compaction':
+      self.compaction_times[-1] = now - self.last
+    self.last = now
+
+
+def profile(width, height, itermax, xmin, xsize, ymin, ysize, escape):
+  """Renders an image like render(), measuring where the time goes.
+
+  The image is rendered by iterate() itself, with a KernelProfiler.
+
+  Returns:
+    A dict holding:
+      occupancy: The number of live pixels at the start of each iteration.
+      phases: Seconds spent on arithmetic, the escape test, colouring
+        escaped pixels, and compacting the live arrays.
+      estimated_allocations: Bytes of arrays allocated in each iteration,
+        estimated from the arrays' sizes.
+      compaction_breakeven: The first iteration by which the arithmetic
+        saved by compacting had repaid the time spent compacting, or None.
+      cost, wall_time: The operation cost and total time of the render.
+  """
+  start_time = time.time()
+  c = grid(width, height, xmin, xsize, ymin, ysize)
+  img = numpy.zeros((height, width, 3), dtype=numpy.uint8)
+  state = OrbitState(numpy.arange(width * height), numpy.copy(c), 0)
+  profiler = KernelProfiler()
+  cost = iterate(img, c, state, itermax, escape, profiler=profiler)[0]
+
+  # Compare the time spent compacting with the arithmetic it saved, at the
+  # measured cost per pixel, on pixels that had escaped.
+  per_pixel = profiler.phases['arithmetic'] / cost if cost else 0.0
+  saved = numpy.cumsum((width * height -
+                        numpy.array(profiler.occupancy, dtype=float)) *
+                       per_pixel)
+  spent = numpy.cumsum(profiler.compaction_times)
+  repaid = numpy.flatnonzero((saved >= spent) & (spent > 0))
+  breakeven = int(repaid[0]) if len(repaid) else None
+
+  return {
+      'occupancy': profiler.occupancy,
+      'phases': profiler.phases,
+      'estimated_allocations': profiler.estimated_allocations,
+      'compaction_breakeven': breakeven,
+      'cost': cost,
+      'wall_time': time.time() - start_time,
+  }
+
+
+def resume(img, state, width, height, itermax, xmin, xsize, ymin, ysize,
+           escape):
+  """Continues rendering an image from saved state with a higher limit.
+
+  Only the pixels that were still live are iterated, so the cost is
+  proportional to the interior of the image rather than its area.
+
+  Args:
+    img: The pixels of the image being rendered, updated in place.
+    state: The OrbitState of the image, updated in place.
+    width, height, xmin, xsize, ymin, ysize, escape: As for mandelbrot().
+    itermax: The new iteration limit.
+  Returns:
+    A (cost, late_escapes) tuple.
+  """
+  c = grid(width, height, xmin, xsize, ymin, ysize, state.index)
+  return iterate(img, c, state, itermax, escape)
 
 
 def mandelbrot(width, height, itermax, xmin, xsize, ymin, ysize, escape):
@@ -97,35 +768,5 @@ def mandelbrot(width, height, itermax, xmin, xsize, ymin, ysize, escape):
     
     Courtesy http://thesamovar.wordpress.com/2009/03/22/fast-fractals-with-python-and-numpy/
     '''
-    xmax = xmin + xsize
-    ymax = ymin + ysize
-    
-    cost = 0
-    iy, ix = numpy.mgrid[0:height, 0:width]
-    x = numpy.linspace(xmin, xmax, width)[ix]
-    y = numpy.linspace(ymin, ymax, height)[iy]
-    c = x + complex(0, 1) * y
-    del x, y
-    img = numpy.zeros((height, width, 3), dtype=numpy.uint8)
-    ix.shape = width * height
-    iy.shape = width * height
-    c.shape = width * height
-    z = numpy.copy(c)
-    for i in xrange(itermax):
-      if not len(z):
-        break
-      cost += len(z)
-      numpy.multiply(z, z, z)
-      numpy.add(z, c, z)
-      rem = abs(z) > escape
-      
-      smooth_index = i + 1 - numpy.log2(numpy.log(abs(z[rem])))
-      smooth_index *= PALETTE_STEP
-      smooth_index %= PALETTE_SIZE
-      img[iy[rem], ix[rem]] = palette[smooth_index.astype(int)]
-
-      rem = -rem
-      z = z[rem]
-      ix, iy = ix[rem], iy[rem]
-      c = c[rem]
-    return img, cost
+    result = render(width, height, itermax, xmin, xsize, ymin, ysize, escape)
+    return result.pixels, result.cost
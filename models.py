@@ -6,6 +6,16 @@ class CachedTile(model.Model):
   operation_cost = model.IntegerProperty(required=True)
   render_time = model.FloatProperty(required=True)
   level = model.IntegerProperty(required=True)
+  # mandelbrot.FINGERPRINT at render time; None for tiles predating it.
+  fingerprint = model.StringProperty()
+  iteration_limit = model.IntegerProperty()
+  # Fraction of pixels that escaped in the last mandelbrot.LATE_FRACTION of
+  # iterations; used to choose the iteration limit of child tiles.
+  late_escapes = model.FloatProperty()
+  # Blob holding the mandelbrot.OrbitState of the unescaped pixels, if saved.
+  orbits = model.BlobKeyProperty()
+  # Iterations spent in each cell of a grid over the tile; see costmodel.
+  cost_map = model.BlobProperty()
 
   #_use_datastore = False
   _use_memcache = False
@@ -1,21 +1,41 @@
 """Context class."""
 
-# TODO: Handle things like request size limits.  E.g. what if we've
-# batched up 1000 entities to put and now the memcache call fails?
+# TODO: What if we've batched up 500 entities to put and now the
+# memcache call fails?
 
+import bisect
+import collections
 import logging
 import sys
+import threading
+import time
 
 from google.appengine.api import datastore  # For taskqueue coordination
 from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
 
 from google.appengine.datastore import datastore_rpc
+from google.appengine.datastore import entity_pb
 
 from . import key as key_module
 from . import model, tasklets, eventloop, utils
 
-_LOCK_TIME = 32  # Time to lock out memcache.add() after datastore.put().
+_LEASE_VALUE = 0  # Memcache value of a key a reader is fetching.
+_LEASE_TIME = 4  # Seconds before an unfilled lease expires.
+_LEASE_POLL = 0.02  # Seconds to wait before polling a leased key again.
+_LEASE_RETRIES = 10  # Polls of a leased key before reading the datastore.
+_CACHE_MAX_ENTRIES = 10000  # Default most entities kept in a Context cache.
+_CACHE_MAX_BYTES = 32 << 20  # Default most (approximate) bytes cached.
+_CACHE_ENTRY_OVERHEAD = 100  # Approximate bytes used by any cache entry.
+_SHARED_CACHE_MAX_ENTRIES = 10000  # Most entities in the process-wide cache.
+_SHARED_CACHE_TIMEOUT = 60  # Default seconds an entity stays shared.
+_GET_BATCH_MAX_ITEMS = 1000  # Default most keys per get RPC.
+_PUT_BATCH_MAX_ITEMS = 500  # Default most entities per put RPC.
+_DELETE_BATCH_MAX_ITEMS = 500  # Default most keys per delete RPC.
+_BATCH_MAX_BYTES = 1 << 20  # Default most (approximate) bytes per RPC.
+_BATCH_SIZE_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]  # Items.
+_BATCH_LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000,
+                          5000]  # Milliseconds.
 
 
 class ContextOptions(datastore_rpc.Configuration):
@@ -53,6 +73,34 @@ class ContextOptions(datastore_rpc.Configuration):
         'memcache_timeout should be an integer (%r)' % (value,))
     return value
 
+  @datastore_rpc.ConfigOption
+  def use_shared_cache(value):
+    if not isinstance(value, bool):
+      raise datastore_errors.BadArgumentError(
+        'use_shared_cache should be a bool (%r)' % (value,))
+    return value
+
+  @datastore_rpc.ConfigOption
+  def batch_max_items(value):
+    if not isinstance(value, (int, long)) or value < 1:
+      raise datastore_errors.BadArgumentError(
+        'batch_max_items should be a positive integer (%r)' % (value,))
+    return value
+
+  @datastore_rpc.ConfigOption
+  def batch_max_bytes(value):
+    if not isinstance(value, (int, long)) or value < 1:
+      raise datastore_errors.BadArgumentError(
+        'batch_max_bytes should be a positive integer (%r)' % (value,))
+    return value
+
+  @datastore_rpc.ConfigOption
+  def batch_linger(value):
+    if not isinstance(value, (int, long, float)) or value < 0:
+      raise datastore_errors.BadArgumentError(
+        'batch_linger should be a non-negative number (%r)' % (value,))
+    return value
+
 
 # For backwards compatibility, translate these option names.
 _OPTION_TRANSLATIONS = {
@@ -90,12 +138,31 @@ def _make_ctx_options(ctx_options):
 
 
 class AutoBatcher(object):
+  """Collects calls made while tasklets run into batches for one tasklet.
+
+  Items added are passed to todo_tasklet once no other tasklet is
+  runnable, or linger seconds after the first one was added.  A batch
+  with more than max_items items, or more than max_bytes (as estimated by
+  _approximate_size), is split, and todo_tasklet is called for each part
+  in parallel.  Either limit may be None, meaning unlimited.
+  """
 
-  def __init__(self, todo_tasklet):
+  def __init__(self, todo_tasklet, max_items=None, max_bytes=None, linger=0):
     # todo_tasklet is a tasklet to be called with list of (future, arg) pairs
     self._todo_tasklet = todo_tasklet
     self._todo = []  # List of (future, arg) pairs
+    self._todo_bytes = 0  # Approximate size of the args in _todo
     self._running = None  # Currently running tasklet, if any
+    self._generation = 0  # Incremented each time _todo is taken
+    self._max_items = max_items
+    self._max_bytes = max_bytes
+    self._linger = linger
+    self._batches = 0
+    self._rpcs = 0
+    self._items = 0
+    self._size_counts = [0] * (len(_BATCH_SIZE_BUCKETS) + 1)
+    self._latency_counts = [0] * (len(_BATCH_LATENCY_BUCKETS) + 1)
+    self._latency_total = 0.0  # Seconds
 
   def __repr__(self):
     return '%s(%s)' % (self.__class__.__name__, self._todo_tasklet.__name__)
@@ -107,31 +174,109 @@ class AutoBatcher(object):
       # which puts them at absolute time 0 (i.e. ASAP -- still on a
       # FIFO basis).  Callbacks explicitly scheduled with a delay of 0
       # are only run after all immediately runnable tasklets have run.
-      eventloop.queue_call(0, self._autobatcher_callback)
+      eventloop.queue_call(self._linger, self._autobatcher_callback,
+                           self._generation)
+    was_full = self._full()
     self._todo.append((fut, arg, options))
+    if self._max_bytes is not None:
+      self._todo_bytes += _approximate_size(arg)
+    if self._linger and not was_full and self._full():
+      # Don't linger once there's a whole RPC's worth.
+      eventloop.queue_call(0, self._autobatcher_callback, self._generation)
     return fut
 
-  def _autobatcher_callback(self):
+  def _full(self):
+    return ((self._max_items is not None and
+             len(self._todo) >= self._max_items) or
+            (self._max_bytes is not None and
+             self._todo_bytes >= self._max_bytes))
+
+  def _split(self, todo):
+    """Split todo into batches that are within max_items and max_bytes."""
+    if self._max_items is None and self._max_bytes is None:
+      return [todo]
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for item in todo:
+      size = 0
+      if self._max_bytes is not None:
+        size = _approximate_size(item[1])
+      if batch and ((self._max_items is not None and
+                     len(batch) >= self._max_items) or
+                    (self._max_bytes is not None and
+                     batch_bytes + size > self._max_bytes)):
+        batches.append(batch)
+        batch = []
+        batch_bytes = 0
+      batch.append(item)
+      batch_bytes += size
+    batches.append(batch)
+    return batches
+
+  def _autobatcher_callback(self, generation=None):
     if not self._todo:
       return
+    if generation is not None and generation != self._generation:
+      # Scheduled for a batch that has already been sent; the current
+      # batch has its own callback, which mustn't be cut short.
+      return
     if self._running is not None:
       # Another callback may still be running.
       if not self._running.done():
         # Wait for it to complete first, then try again.
-        self._running.add_callback(self._autobatcher_callback)
+        self._running.add_callback(self._autobatcher_callback, generation)
         return
       self._running = None
     # We cannot postpone the inevitable any longer.
     todo = self._todo
     self._todo = []  # Get ready for the next batch
-    # TODO: Use logging_debug(), at least if len(todo) == 1.
-    logging.info('AutoBatcher(%s): %d items',
-                 self._todo_tasklet.__name__, len(todo))
-    self._running = self._todo_tasklet(todo)
+    self._generation += 1
+    self._todo_bytes = 0
+    batches = self._split(todo)
+    utils.logging_debug('AutoBatcher(%s): %d items in %d RPCs',
+                        self._todo_tasklet.__name__, len(todo), len(batches))
+    self._batches += 1
+    self._items += len(todo)
+    if len(batches) == 1:
+      self._running = self._start_rpc(batches[0])
+    else:
+      self._running = tasklets.MultiFuture('%s._autobatcher_callback' % self)
+      for batch in batches:
+        self._running.add_dependent(self._start_rpc(batch))
+      self._running.complete()
     # Add a callback to the Future to propagate exceptions,
     # since this Future is not normally checked otherwise.
     self._running.add_callback(self._running.check_success)
 
+  def _start_rpc(self, batch):
+    self._rpcs += 1
+    self._size_counts[bisect.bisect_left(_BATCH_SIZE_BUCKETS, len(batch))] += 1
+    fut = self._todo_tasklet(batch)
+    fut.add_callback(self._rpc_done, time.time())
+    return fut
+
+  def _rpc_done(self, start):
+    elapsed = time.time() - start
+    self._latency_total += elapsed
+    self._latency_counts[bisect.bisect_left(_BATCH_LATENCY_BUCKETS,
+                                            int(elapsed * 1000))] += 1
+
+  def stats(self):
+    """Return a dict of metrics about the batches run so far.
+
+    Returns:
+      A dict with counts of 'batches', 'rpcs' and 'items'; the total
+      'rpc_time' in seconds; and histograms 'batch_sizes' and
+      'rpc_latency', lists with a count for each bucket in
+      _BATCH_SIZE_BUCKETS and _BATCH_LATENCY_BUCKETS respectively, plus one
+      for anything larger.
+    """
+    return {'batches': self._batches, 'rpcs': self._rpcs,
+            'items': self._items, 'rpc_time': self._latency_total,
+            'batch_sizes': list(self._size_counts),
+            'rpc_latency': list(self._latency_counts)}
+
   @tasklets.tasklet
   def flush(self):
     while self._running or self._todo:
@@ -145,19 +290,220 @@ class AutoBatcher(object):
         self._autobatcher_callback()
 
 
+def _approximate_size(value):
+  """Estimate the memory used by an entity or property value, in bytes."""
+  if value is None:
+    return 0
+  if isinstance(value, basestring):
+    return len(value)
+  if isinstance(value, (list, tuple)):
+    return sum(_approximate_size(v) for v in value)
+  if isinstance(value, model.Model):
+    return sum(_approximate_size(v) for v in value._values.itervalues())
+  if isinstance(value, model._LazyValue):
+    # The undecoded protobufs are what the entity is holding on to.
+    return sum(p.ByteSize() for p in value.plist)
+  return 16
+
+
+class LRUCache(object):
+  """A dict-like cache that evicts its least recently used entries.
+
+  Entries are evicted once there are more than max_entries of them, or
+  their approximate total size exceeds max_bytes.  Either limit may be
+  None, meaning unlimited.  Values may be None, which Context uses to
+  record that an entity doesn't exist; these are kept like any other.
+  """
+
+  def __init__(self, max_entries=None, max_bytes=None,
+               size_func=_approximate_size):
+    self._entries = collections.OrderedDict()  # Maps keys to (value, size).
+    self._max_entries = max_entries
+    self._max_bytes = max_bytes
+    self._size_func = size_func
+    self._bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __repr__(self):
+    return '%s(%d entries, %d bytes)' % (self.__class__.__name__,
+                                         len(self._entries), self._bytes)
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __iter__(self):
+    return iter(self._entries)
+
+  def __contains__(self, key):
+    if key in self._entries:
+      return True
+    self.misses += 1
+    return False
+
+  def __getitem__(self, key):
+    value, size = self._entries.pop(key)  # Raises KeyError if missing.
+    self._entries[key] = (value, size)  # Now the most recently used.
+    self.hits += 1
+    return value
+
+  def get(self, key, default=None):
+    if key in self:
+      return self[key]
+    return default
+
+  def __setitem__(self, key, value):
+    if key in self._entries:
+      self._bytes -= self._entries.pop(key)[1]
+    size = self._size_func(value) + _CACHE_ENTRY_OVERHEAD
+    self._entries[key] = (value, size)
+    self._bytes += size
+    self._evict()
+
+  def __delitem__(self, key):
+    self._bytes -= self._entries.pop(key)[1]
+
+  def update(self, other):
+    for key in other:
+      self[key] = other[key]
+
+  def clear(self):
+    self._entries.clear()
+    self._bytes = 0
+
+  def _evict(self):
+    # Always keep the newest entry, even if it is over max_bytes by itself.
+    while len(self._entries) > 1 and (
+        (self._max_entries is not None and
+         len(self._entries) > self._max_entries) or
+        (self._max_bytes is not None and self._bytes > self._max_bytes)):
+      key, (value, size) = self._entries.popitem(last=False)
+      self._bytes -= size
+      self.evictions += 1
+
+  def stats(self):
+    """Return a dict of counters describing the cache's use."""
+    return {'entries': len(self._entries), 'bytes': self._bytes,
+            'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions}
+
+
+class SharedCache(object):
+  """A thread-safe cache of entities shared by every Context in the process.
+
+  Entities are stored serialized, so each reader gets its own copy, and
+  expire after a per-key timeout.  Puts and deletes through any Context
+  invalidate the keys they write.  To stop a reader that started before a
+  write from filling the cache with what it read, fills carry a token from
+  token(), and are dropped if the key was invalidated after it was issued.
+  """
+
+  def __init__(self, max_entries=_SHARED_CACHE_MAX_ENTRIES):
+    self._lock = threading.Lock()
+    self._entries = LRUCache(max_entries)  # Maps keys to (data, expires).
+    self._max_entries = max_entries
+    self._counter = 0  # Incremented by every invalidation.
+    self._invalidated = {}  # Maps keys to the counter when last invalidated.
+    self._floor = 0  # Counter when _invalidated was last emptied.
+
+  def token(self):
+    """Return a token to pass to set() for values read after this call."""
+    with self._lock:
+      return self._counter
+
+  def get(self, key):
+    """Return the serialized entity for key, or None."""
+    with self._lock:
+      if key not in self._entries:
+        return None
+      data, expires = self._entries[key]
+      if expires < time.time():
+        del self._entries[key]
+        return None
+      return data
+
+  def set(self, key, data, timeout, token):
+    """Store a serialized entity, unless key was invalidated since token."""
+    with self._lock:
+      if self._invalidated.get(key, self._floor) > token:
+        return
+      self._entries[key] = (data, time.time() + timeout)
+
+  def invalidate(self, keys):
+    """Remove keys, which are being or have been written."""
+    with self._lock:
+      self._counter += 1
+      if len(self._invalidated) > self._max_entries:
+        # Forget individual keys; fills older than this are all dropped.
+        self._invalidated.clear()
+        self._floor = self._counter
+      for key in keys:
+        if key in self._entries:
+          del self._entries[key]
+        self._invalidated[key] = self._counter
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def stats(self):
+    with self._lock:
+      return self._entries.stats()
+
+
+_shared_cache = SharedCache()
+
+
 class Context(object):
 
-  def __init__(self, conn=None, auto_batcher_class=AutoBatcher, config=None):
+  def __init__(self, conn=None, auto_batcher_class=AutoBatcher, config=None,
+               cache=None):
+    """Constructor.
+
+    Args:
+      conn: A datastore Connection, or None to make one from config.
+      auto_batcher_class: The class used to batch gets, puts and deletes.
+      config: A ContextOptions instance, used only if conn is None.
+      cache: A dict-like object for the in-memory cache, such as an
+        LRUCache.  The default is an LRUCache bounded by _CACHE_MAX_ENTRIES
+        and _CACHE_MAX_BYTES.
+    """
     if conn is None:
       conn = model.make_connection(config)
     else:
       assert config is None  # It wouldn't be used.
     self._conn = conn
     self._auto_batcher_class = auto_batcher_class
-    self._get_batcher = auto_batcher_class(self._get_tasklet)
-    self._put_batcher = auto_batcher_class(self._put_tasklet)
-    self._delete_batcher = auto_batcher_class(self._delete_tasklet)
-    self._cache = {}
+    self._get_batcher = self._make_batcher(self._get_tasklet,
+                                           _GET_BATCH_MAX_ITEMS)
+    self._put_batcher = self._make_batcher(self._put_tasklet,
+                                           _PUT_BATCH_MAX_ITEMS)
+    self._delete_batcher = self._make_batcher(self._delete_tasklet,
+                                              _DELETE_BATCH_MAX_ITEMS)
+    if cache is None:
+      cache = LRUCache(_CACHE_MAX_ENTRIES, _CACHE_MAX_BYTES)
+    self._cache = cache
+    # Keys put or deleted in this transaction, invalidated after the commit.
+    self._written_keys = set()
+
+  def _make_batcher(self, todo_tasklet, max_items):
+    config = self._conn.config
+    max_items = ContextOptions.batch_max_items(config) or max_items
+    max_bytes = ContextOptions.batch_max_bytes(config) or _BATCH_MAX_BYTES
+    linger = ContextOptions.batch_linger(config) or 0
+    return self._auto_batcher_class(todo_tasklet, max_items=max_items,
+                                    max_bytes=max_bytes, linger=linger)
+
+  def get_batcher_stats(self):
+    """Return the stats() of the get, put and delete batchers.
+
+    Returns:
+      A dict mapping 'get', 'put' and 'delete' to AutoBatcher.stats() dicts.
+    """
+    return {'get': self._get_batcher.stats(),
+            'put': self._put_batcher.stats(),
+            'delete': self._delete_batcher.stats()}
 
   # TODO: Set proper namespace for memcache.
 
@@ -172,24 +518,53 @@ class Context(object):
   @tasklets.tasklet
   def _get_tasklet(self, todo):
     assert todo
-    # First check memcache.
+    # First check the shared cache.
+    leftover = []
+    for fut, key, options in todo:
+      if self._use_shared_cache(key, options):
+        data = _shared_cache.get(key)
+        if data is not None:
+          fut.set_result(self._conn.adapter.pb_to_entity(
+              entity_pb.EntityProto(data)))
+          continue
+      leftover.append((fut, key, options))
+    todo = leftover
+    if not todo:
+      return
+    token = _shared_cache.token()
+    # Then check memcache.
     memkeymap = {}
     for fut, key, options in todo:
       if self._use_memcache(key, options):
         memkeymap[key] = key.urlsafe()
+    client = None
+    leases = {}
+    waiting = []
     if memkeymap:
-      results = memcache.get_multi(memkeymap.values(),
-                                   key_prefix=self._memcache_prefix)
-      leftover = []
-      for fut, key, options in todo:
-        mkey = memkeymap.get(key)
-        if mkey is not None and mkey in results:
-          pb = results[mkey]
-          ent = self._conn.adapter.pb_to_entity(pb)
-          fut.set_result(ent)
-        else:
-          leftover.append((fut, key, options))
-      todo = leftover
+      todo, waiting, client, leases = yield self._memcache_get_tasklet(
+          todo, memkeymap, token)
+    # Read our misses while polling the keys other readers are fetching.
+    futures = []
+    if todo:
+      futures.append(self._datastore_get_tasklet(todo, memkeymap, client,
+                                                 leases, token))
+    if waiting:
+      futures.append(self._memcache_poll_tasklet(waiting, memkeymap, token))
+    if futures:
+      yield futures
+
+  @tasklets.tasklet
+  def _datastore_get_tasklet(self, todo, memkeymap, client, leases, token):
+    """Read todo from the datastore, filling the memcache keys we lease.
+
+    Args:
+      todo: A list of (future, key, options) tuples.
+      memkeymap: A dict mapping the keys that use memcache to their
+        memcache keys.
+      client: The memcache Client holding the leases, or None.
+      leases: A dict whose keys are the memcache keys we hold leases on.
+      token: The shared cache token for the entities read.
+    """
     # Segregate things by ConfigOptions.
     by_options = {}
     for fut, key, options in todo:
@@ -201,6 +576,7 @@ class Context(object):
       keys.append(key)
     # Make the RPC calls.
     mappings = {}  # Maps timeout value to {urlsafe_key: pb} mapping.
+    releases = []  # Leased keys that don't exist, for memcache.delete_multi().
     for options, (futures, keys) in by_options.iteritems():
       datastore_futures = []
       datastore_keys = []
@@ -214,21 +590,143 @@ class Context(object):
         entities = yield self._conn.async_get(options, datastore_keys)
         for ent, fut, key in zip(entities, datastore_futures, datastore_keys):
           fut.set_result(ent)
-          if ent is not None and self._use_memcache(key, options):
+          if ent is not None and self._use_shared_cache(key, options):
+            self._fill_shared_cache(key, options,
+                                    self._conn.adapter.entity_to_pb(ent),
+                                    token)
+          mkey = memkeymap.get(key)
+          if mkey not in leases:
+            continue
+          if ent is None:
+            releases.append(mkey)
+          else:
             pb = self._conn.adapter.entity_to_pb(ent)
             timeout = self._get_memcache_timeout(key, options)
             mapping = mappings.get(timeout)
             if mapping is None:
               mapping = mappings[timeout] = {}
-            mapping[ent._key.urlsafe()] = pb
+            mapping[mkey] = pb
     if mappings:
       # If the timeouts are not uniform, make a separate call for each
       # distinct timeout value.
       for timeout, mapping in mappings.iteritems():
-        # Use add, not set.  This is a no-op within _LOCK_TIME seconds
-        # of the delete done by the most recent write.
-        memcache.add_multi(mapping, time=timeout,
-                           key_prefix=self._memcache_prefix)
+        # Use cas, not set.  This replaces our lease unless a write has
+        # deleted it since, in which case what we read may be stale.
+        client.cas_multi(mapping, time=timeout,
+                         key_prefix=self._memcache_prefix)
+    if releases:
+      memcache.delete_multi(releases, key_prefix=self._memcache_prefix)
+
+  @tasklets.tasklet
+  def _memcache_get_tasklet(self, todo, memkeymap, token):
+    """Look up todo in memcache, taking leases on the keys that are missing.
+
+    A lease is a placeholder value added to memcache by the first reader
+    to miss a key.  Since it is added with add(), only one reader gets it;
+    other readers poll the key (see _memcache_poll_tasklet()) until the
+    lease holder replaces it with the entity.  So when a popular key is
+    evicted or written, only one reader fetches it from the datastore.
+
+    Args:
+      todo: A list of (future, key, options) tuples.
+      memkeymap: A dict mapping the keys that use memcache to their
+        memcache keys.
+      token: The shared cache token for the entities read.
+
+    Returns:
+      A tuple (leftover, waiting, client, leases): the items of todo to
+      read from the datastore now, the items leased by other readers, the
+      memcache Client holding our leases, and a dict whose keys are the
+      memcache keys we hold leases on, to fill with client.cas_multi() or
+      release with memcache.delete_multi().
+    """
+    client = memcache.Client()
+    results = memcache.get_multi([memkeymap[key] for fut, key, options
+                                  in todo if key in memkeymap],
+                                 key_prefix=self._memcache_prefix)
+    leftover = []
+    waiting = []
+    missing = {}  # Maps memcache keys to _LEASE_VALUE, for add_multi().
+    for fut, key, options in todo:
+      mkey = memkeymap.get(key)
+      value = results.get(mkey)
+      if value is None:
+        if mkey is not None and self._use_datastore(key, options):
+          missing[mkey] = _LEASE_VALUE
+        leftover.append((fut, key, options))
+      elif isinstance(value, (int, long)):
+        waiting.append((fut, key, options))  # Another reader's lease.
+      else:
+        fut.set_result(self._conn.adapter.pb_to_entity(value))
+        self._fill_shared_cache(key, options, value, token)
+    leases = {}
+    if missing:
+      failed = memcache.add_multi(missing, time=_LEASE_TIME,
+                                  key_prefix=self._memcache_prefix)
+      if failed:
+        # Another reader leased these since our get; wait for it too.
+        failed = set(failed)
+        for mkey in failed:
+          del missing[mkey]
+        waiting.extend(item for item in leftover
+                       if memkeymap.get(item[1]) in failed)
+        leftover = [item for item in leftover
+                    if memkeymap.get(item[1]) not in failed]
+      if missing:
+        # Fetch CAS ids for our leases; any deleted already are dropped.
+        results = client.get_multi(missing.keys(), for_cas=True,
+                                   key_prefix=self._memcache_prefix)
+        for mkey, value in results.iteritems():
+          if isinstance(value, (int, long)):
+            leases[mkey] = value
+    raise tasklets.Return(leftover, waiting, client, leases)
+
+  @tasklets.tasklet
+  def _memcache_poll_tasklet(self, todo, memkeymap, token):
+    """Wait for the readers leasing todo's keys to fill them in memcache.
+
+    Keys whose lease is released or deleted by a write, and keys still
+    leased after _LEASE_RETRIES polls, are read from the datastore without
+    filling memcache.
+
+    Args:
+      todo: A list of (future, key, options) tuples.
+      memkeymap: A dict mapping todo's keys to their memcache keys.
+      token: The shared cache token for the entities read.
+    """
+    futures = []
+    for retry in xrange(_LEASE_RETRIES):
+      yield tasklets.sleep(_LEASE_POLL)
+      results = memcache.get_multi([memkeymap[key] for fut, key, options
+                                    in todo],
+                                   key_prefix=self._memcache_prefix)
+      waiting = []
+      gone = []
+      for fut, key, options in todo:
+        value = results.get(memkeymap[key])
+        if value is None:
+          gone.append((fut, key, options))
+        elif isinstance(value, (int, long)):
+          waiting.append((fut, key, options))
+        else:
+          fut.set_result(self._conn.adapter.pb_to_entity(value))
+          self._fill_shared_cache(key, options, value, token)
+      if gone:
+        futures.append(self._datastore_get_tasklet(gone, memkeymap, None, {},
+                                                   token))
+      todo = waiting
+      if not todo:
+        break
+    if todo:
+      futures.append(self._datastore_get_tasklet(todo, memkeymap, None, {},
+                                                 token))
+    if futures:
+      yield futures
+
+  def _fill_shared_cache(self, key, options, pb, token):
+    if self._use_shared_cache(key, options):
+      _shared_cache.set(key, pb.Encode(),
+                        self._get_shared_cache_timeout(key, options), token)
 
   @tasklets.tasklet
   def _put_tasklet(self, todo):
@@ -265,15 +763,14 @@ class Context(object):
       futures.append(fut)
       entities.append(ent)
     if delete_keys:  # Pre-emptively delete from memcache.
-      memcache.delete_multi(delete_keys, seconds=_LOCK_TIME,
-                            key_prefix=self._memcache_prefix)
+      memcache.delete_multi(delete_keys, key_prefix=self._memcache_prefix)
+    _shared_cache.invalidate([ent._key for fut, ent, options in todo
+                              if ent._has_complete_key()])
     if mappings:  # Write to memcache (only if use_datastore=False).
       # If the timeouts are not uniform, make a separate call for each
       # distinct timeout value.
       for timeout, mapping in mappings.iteritems():
-        # Use add, not set.  This is a no-op within _LOCK_TIME seconds
-        # of the delete done by the most recent write.
-        memcache.add_multi(mapping, time=timeout,
+        memcache.set_multi(mapping, time=timeout,
                            key_prefix=self._memcache_prefix)
     for options, (futures, entities) in by_options.iteritems():
       datastore_futures = []
@@ -291,6 +788,13 @@ class Context(object):
           fut.set_result(ent._key)
       if datastore_entities:
         keys = yield self._conn.async_put(options, datastore_entities)
+        # Readers may have refilled the caches during the put; deleting
+        # their leases makes their fills fail.
+        _shared_cache.invalidate(keys)
+        if self.in_transaction():
+          self._written_keys.update(keys)
+        if delete_keys:
+          memcache.delete_multi(delete_keys, key_prefix=self._memcache_prefix)
         for key, fut, ent in zip(keys, datastore_futures, datastore_entities):
           if key != ent._key:
             if ent._has_complete_key():
@@ -315,8 +819,8 @@ class Context(object):
       futures.append(fut)
       keys.append(key)
     if delete_keys:  # Pre-emptively delete from memcache.
-      memcache.delete_multi(delete_keys, seconds=_LOCK_TIME,
-                            key_prefix=self._memcache_prefix)
+      memcache.delete_multi(delete_keys, key_prefix=self._memcache_prefix)
+    _shared_cache.invalidate([key for fut, key, options in todo])
     for options, (futures, keys) in by_options.iteritems():
       datastore_keys = []
       for key in keys:
@@ -324,6 +828,11 @@ class Context(object):
           datastore_keys.append(key)
       if datastore_keys:
         yield self._conn.async_delete(options, datastore_keys)
+        _shared_cache.invalidate(datastore_keys)
+        if self.in_transaction():
+          self._written_keys.update(datastore_keys)
+        if delete_keys:
+          memcache.delete_multi(delete_keys, key_prefix=self._memcache_prefix)
       for fut in futures:
         fut.set_result(None)
 
@@ -595,6 +1104,127 @@ class Context(object):
       timeout = 0
     return timeout
 
+  @staticmethod
+  def default_shared_cache_policy(key):
+    """Default shared cache policy.
+
+    This defers to _use_shared_cache on the Model class.
+
+    Args:
+      key: Key instance.
+
+    Returns:
+      A bool or None.
+    """
+    flag = None
+    if key is not None:
+      modelclass = model.Model._kind_map.get(key.kind())
+      if modelclass is not None:
+        policy = getattr(modelclass, '_use_shared_cache', None)
+        if policy is not None:
+          if isinstance(policy, bool):
+            flag = policy
+          else:
+            flag = policy(key)
+    return flag
+
+  _shared_cache_policy = default_shared_cache_policy
+
+  def get_shared_cache_policy(self):
+    """Return the current shared cache policy function.
+
+    Returns:
+      A function that accepts a Key instance as argument and returns
+      a bool indicating if it should be shared.  May be None.
+    """
+    return self._shared_cache_policy
+
+  def set_shared_cache_policy(self, func):
+    """Set the shared cache policy function.
+
+    Args:
+      func: A function that accepts a Key instance as argument and returns
+        a bool indicating if it should be shared.  May be None.
+    """
+    if func is None:
+      func = self.default_shared_cache_policy
+    elif isinstance(func, bool):
+      func = lambda key, flag=func: flag
+    self._shared_cache_policy = func
+
+  def _use_shared_cache(self, key, options=None):
+    """Return whether to use the process-wide shared cache for this key.
+
+    Transactions never use it, since they must read from the datastore.
+
+    Args:
+      key: Key instance.
+      options: ContextOptions instance, or None.
+
+    Returns:
+      True if the key should be shared, False otherwise.
+    """
+    if self.in_transaction():
+      return False
+    flag = ContextOptions.use_shared_cache(options)
+    if flag is None:
+      flag = self._shared_cache_policy(key)
+    if flag is None:
+      flag = ContextOptions.use_shared_cache(self._conn.config)
+    if flag is None:
+      flag = False
+    return flag
+
+  @staticmethod
+  def default_shared_cache_timeout_policy(key):
+    """Default shared cache timeout policy.
+
+    This defers to _shared_cache_timeout on the Model class.
+
+    Args:
+      key: Key instance.
+
+    Returns:
+      Shared cache timeout to use (integer), or None.
+    """
+    timeout = None
+    if key is not None:
+      modelclass = model.Model._kind_map.get(key.kind())
+      if modelclass is not None:
+        policy = getattr(modelclass, '_shared_cache_timeout', None)
+        if policy is not None:
+          if isinstance(policy, (int, long)):
+            timeout = policy
+          else:
+            timeout = policy(key)
+    return timeout
+
+  _shared_cache_timeout_policy = default_shared_cache_timeout_policy
+
+  def set_shared_cache_timeout_policy(self, func):
+    """Set the policy function for shared cache timeout (expiration).
+
+    Args:
+      func: A function that accepts a key instance as argument and returns
+        an integer indicating the desired timeout in seconds.  May be None.
+    """
+    if func is None:
+      func = self.default_shared_cache_timeout_policy
+    elif isinstance(func, (int, long)):
+      func = lambda key, flag=func: flag
+    self._shared_cache_timeout_policy = func
+
+  def get_shared_cache_timeout_policy(self):
+    """Return the current policy function for shared cache timeout."""
+    return self._shared_cache_timeout_policy
+
+  def _get_shared_cache_timeout(self, key, options=None):
+    """Return the shared cache timeout (expiration) for this key."""
+    timeout = self._shared_cache_timeout_policy(key)
+    if timeout is None:
+      timeout = _SHARED_CACHE_TIMEOUT
+    return timeout
+
   # TODO: What about conflicting requests to different autobatchers,
   # e.g. tasklet A calls get() on a given key while tasklet B calls
   # delete()?  The outcome is nondeterministic, depending on which
@@ -744,8 +1374,11 @@ class Context(object):
         config=self._conn.config,
         transaction=transaction,
         entity_group=entity_group)
+      # The transaction's cache mustn't evict anything: its keys are used
+      # to clear memcache after the commit.
       tctx = self.__class__(conn=tconn,
-                            auto_batcher_class=self._auto_batcher_class)
+                            auto_batcher_class=self._auto_batcher_class,
+                            cache=LRUCache())
       tctx.set_memcache_policy(False)
       tasklets.set_context(tctx)
       old_ds_conn = datastore._GetConnection()
@@ -771,6 +1404,9 @@ class Context(object):
             # TODO: This is questionable when self is transactional.
             self._cache.update(tctx._cache)
             self._clear_memcache(tctx._cache)
+            # Until the commit, readers could still see and share the old
+            # entities, whatever the transaction's cache holds.
+            _shared_cache.invalidate(list(tctx._written_keys))
             raise tasklets.Return(result)
       finally:
         datastore._SetConnection(old_ds_conn)
@@ -793,6 +1429,13 @@ class Context(object):
   # Backwards compatible alias.
   flush_cache = clear_cache  # TODO: Remove this after one release.
 
+  def get_cache_stats(self):
+    """Return a dict of statistics about the in-memory cache, if any."""
+    stats = getattr(self._cache, 'stats', None)
+    if stats is None:
+      return {'entries': len(self._cache)}
+    return stats()
+
   def _clear_memcache(self, keys):
     keys = set(key for key in keys if self._use_memcache(key))
     if keys:
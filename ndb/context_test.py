@@ -28,11 +28,11 @@ class MyAutoBatcher(context.AutoBatcher):
   def reset_log(cls):
     cls._log = []
 
-  def __init__(self, todo_tasklet):
+  def __init__(self, todo_tasklet, **kwds):
     def wrap(*args):
       self.__class__._log.append(args)
       return todo_tasklet(*args)
-    super(MyAutoBatcher, self).__init__(wrap)
+    super(MyAutoBatcher, self).__init__(wrap, **kwds)
 
 
 class ContextTests(test_utils.DatastoreTest):
@@ -121,6 +121,68 @@ class ContextTests(test_utils.DatastoreTest):
     keys = foo().get_result()
     self.assertEqual(len(keys), 10)
 
+  def testContext_AutoBatcher_Split(self):
+    config = context.ContextOptions(batch_max_items=4)
+    self.ctx = context.Context(
+        conn=model.make_connection(config, default_model=model.Expando),
+        auto_batcher_class=MyAutoBatcher)
+    @tasklets.tasklet
+    def foo():
+      ents = [model.Expando() for i in range(10)]
+      keys = yield [self.ctx.put(ent) for ent in ents]
+      raise tasklets.Return(keys)
+    keys = foo().get_result()
+    self.assertEqual(len(keys), 10)
+    self.assertEqual([len(todo) for todo, in MyAutoBatcher._log], [4, 4, 2])
+    stats = self.ctx.get_batcher_stats()['put']
+    self.assertEqual(stats['batches'], 1)
+    self.assertEqual(stats['rpcs'], 3)
+    self.assertEqual(stats['items'], 10)
+    self.assertEqual(sum(stats['batch_sizes']), 3)
+    self.assertEqual(sum(stats['rpc_latency']), 3)
+
+  def testAutoBatcher_SplitBytes(self):
+    batcher = context.AutoBatcher(None, max_bytes=100)
+    todo = [(None, 'x' * 40, None) for i in range(5)]
+    self.assertEqual([len(batch) for batch in batcher._split(todo)],
+                     [2, 2, 1])
+    todo = [(None, 'x' * 500, None), (None, 'x', None)]
+    self.assertEqual([len(batch) for batch in batcher._split(todo)], [1, 1])
+
+  def testContext_AutoBatcher_Linger(self):
+    config = context.ContextOptions(batch_linger=0.05)
+    self.ctx = context.Context(
+        conn=model.make_connection(config, default_model=model.Expando),
+        auto_batcher_class=MyAutoBatcher)
+    @tasklets.tasklet
+    def foo():
+      fut1 = self.ctx.get(model.Key(flat=['Foo', 1]))
+      yield tasklets.sleep(0.01)  # Would have flushed without linger.
+      fut2 = self.ctx.get(model.Key(flat=['Foo', 2]))
+      yield fut1, fut2
+    foo().check_success()
+    self.assertEqual(len(MyAutoBatcher._log), 1)
+
+  def testContext_AutoBatcher_LingerAfterFull(self):
+    config = context.ContextOptions(batch_linger=0.2, batch_max_items=2)
+    self.ctx = context.Context(
+        conn=model.make_connection(config, default_model=model.Expando),
+        auto_batcher_class=MyAutoBatcher)
+    @tasklets.tasklet
+    def foo():
+      # A full batch is sent at once, before its linger expires.
+      yield (self.ctx.get(model.Key(flat=['Foo', 1])),
+             self.ctx.get(model.Key(flat=['Foo', 2])))
+      self.assertEqual(len(MyAutoBatcher._log), 1)
+      yield tasklets.sleep(0.1)
+      fut3 = self.ctx.get(model.Key(flat=['Foo', 3]))
+      # The full batch's linger expires now, but mustn't send this batch.
+      yield tasklets.sleep(0.15)
+      self.assertEqual(len(MyAutoBatcher._log), 1)
+      yield fut3
+      self.assertEqual(len(MyAutoBatcher._log), 2)
+    foo().check_success()
+
   def testContext_Cache(self):
     @tasklets.tasklet
     def foo():
@@ -177,6 +239,135 @@ class ContextTests(test_utils.DatastoreTest):
     self.ctx.set_cache_policy(lambda key: False)
     self.assertEqual(self.ctx.get(key1).get_result(), ent1)
 
+  def testContext_CacheEviction(self):
+    self.ctx = context.Context(
+        conn=model.make_connection(default_model=model.Expando),
+        auto_batcher_class=MyAutoBatcher,
+        cache=context.LRUCache(max_entries=2))
+    @tasklets.tasklet
+    def foo():
+      key1 = model.Key(flat=('Foo', 1))
+      key2 = model.Key(flat=('Foo', 2))
+      key3 = model.Key(flat=('Foo', 3))
+      ent1 = model.Expando(key=key1, foo=1)
+      ent2 = model.Expando(key=key2, foo=2)
+      yield self.ctx.put(ent1), self.ctx.put(ent2)
+      a = yield self.ctx.get(key1)  # key1 is now the most recently used.
+      self.assertTrue(a is ent1)
+      b = yield self.ctx.get(key3)  # Caches a negative entry, evicting key2.
+      self.assertTrue(b is None)
+      self.assertTrue(key1 in self.ctx._cache)  # Whitebox.
+      self.assertTrue(key2 not in self.ctx._cache)  # Whitebox.
+      self.assertTrue(self.ctx._cache[key3] is None)  # Whitebox.
+      c = yield self.ctx.get(key2)
+      self.assertTrue(c is not ent2)
+      self.assertEqual(c, ent2)
+    foo().check_success()
+    stats = self.ctx.get_cache_stats()
+    self.assertEqual(stats['entries'], 2)
+    self.assertEqual(stats['evictions'], 2)
+
+  def testLRUCache_Bytes(self):
+    cache = context.LRUCache(max_bytes=300, size_func=len)
+    cache['a'] = 'x' * 50
+    cache['b'] = 'x' * 50
+    self.assertEqual(len(cache), 2)
+    cache['c'] = 'x' * 50  # Each entry also costs _CACHE_ENTRY_OVERHEAD.
+    self.assertEqual(sorted(cache), ['b', 'c'])
+    cache['d'] = 'x' * 1000  # Too big by itself, but the newest is kept.
+    self.assertEqual(list(cache), ['d'])
+    del cache['d']
+    self.assertEqual(cache.stats()['bytes'], 0)
+
+  def testApproximateSize_Lazy(self):
+    class Blob(model.Model):
+      data = model.BlobProperty()
+    pb = Blob(data='x' * 1000)._to_pb()
+    eager = context._approximate_size(Blob._from_pb(pb))
+    lazy = context._approximate_size(Blob._from_pb(pb, lazy=True))
+    self.assertEqual(eager, 1000)
+    self.assertTrue(lazy > 1000, lazy)
+
+  def testLRUCache_Stats(self):
+    cache = context.LRUCache()
+    cache['a'] = None
+    self.assertTrue('a' in cache)
+    self.assertTrue(cache['a'] is None)
+    self.assertFalse('b' in cache)
+    self.assertEqual(cache.get('b', 42), 42)
+    self.assertEqual(cache.stats(), {'entries': 1, 'bytes': 100, 'hits': 1,
+                                     'misses': 2, 'evictions': 0})
+    cache.clear()
+    self.assertEqual(len(cache), 0)
+
+  def testContext_SharedCache(self):
+    context._shared_cache.clear()
+    config = context.ContextOptions(use_shared_cache=True, use_memcache=False)
+    ctx1 = context.Context(
+        conn=model.make_connection(config=config,
+                                   default_model=model.Expando))
+    ctx2 = context.Context(
+        conn=model.make_connection(config=config,
+                                   default_model=model.Expando))
+    key = model.Key(flat=('Foo', 1))
+    ent = model.Expando(key=key, foo=42)
+    ctx1.put(ent).check_success()
+    self.assertEqual(context._shared_cache.get(key), None)  # Invalidated.
+    self.assertEqual(ctx1.get(key, use_cache=False).get_result(), ent)
+    self.assertTrue(context._shared_cache.get(key) is not None)
+    # The second context is served a copy from the shared cache.
+    context._shared_cache.set(
+        key, ctx1._conn.adapter.entity_to_pb(
+            model.Expando(key=key, foo=43)).Encode(), 60,
+        context._shared_cache.token())
+    b = ctx2.get(key).get_result()
+    self.assertEqual(b.foo, 43)
+    # A put through either context invalidates it.
+    ctx2.put(model.Expando(key=key, foo=44)).check_success()
+    self.assertEqual(context._shared_cache.get(key), None)
+    self.assertEqual(ctx1.get(key, use_cache=False).get_result().foo, 44)
+    ctx1.delete(key).check_success()
+    self.assertEqual(context._shared_cache.get(key), None)
+    self.assertEqual(ctx2.get(key, use_cache=False).get_result(), None)
+
+  def testSharedCache_Expiry(self):
+    cache = context.SharedCache()
+    cache.set('a', 'data', -1, cache.token())
+    self.assertEqual(cache.get('a'), None)
+    cache.set('a', 'data', 60, cache.token())
+    self.assertEqual(cache.get('a'), 'data')
+
+  def testSharedCache_StaleFill(self):
+    cache = context.SharedCache()
+    token = cache.token()
+    cache.invalidate(['a'])  # A write finishes after the read started.
+    cache.set('a', 'stale', 60, token)
+    self.assertEqual(cache.get('a'), None)
+    cache.set('b', 'fresh', 60, token)  # Other keys are unaffected.
+    self.assertEqual(cache.get('b'), 'fresh')
+
+  def testSharedCache_Transaction(self):
+    context._shared_cache.clear()
+    class Foo(model.Model):
+      _use_cache = False
+      _use_shared_cache = True
+      bar = model.IntegerProperty()
+    config = context.ContextOptions(use_memcache=False)
+    reader = context.Context(conn=model.make_connection(config=config))
+    key = model.Key(Foo, 1)
+    self.ctx.put(Foo(key=key, bar=1)).check_success()
+    @tasklets.tasklet
+    def callback():
+      yield tasklets.get_context().put(Foo(key=key, bar=2))
+      # A reader outside the transaction refills the shared cache with the
+      # entity as it was before the commit.
+      ent = yield reader.get(key)
+      self.assertEqual(ent.bar, 1)
+      self.assertTrue(context._shared_cache.get(key) is not None)
+    self.ctx.transaction(callback).check_success()
+    self.assertEqual(context._shared_cache.get(key), None)
+    self.assertEqual(reader.get(key).get_result().bar, 2)
+
   def testContext_Memcache(self):
     @tasklets.tasklet
     def foo():
@@ -201,9 +392,9 @@ class ContextTests(test_utils.DatastoreTest):
 
   def testContext_MemcachePolicy(self):
     badkeys = []
-    def tracking_add_multi(*args, **kwds):
+    def tracking_cas_multi(client, *args, **kwds):
       try:
-        res = save_add_multi(*args, **kwds)
+        res = save_cas_multi(client, *args, **kwds)
         if badkeys and not res:
           res = badkeys
         track.append((args, kwds, res, None))
@@ -224,9 +415,9 @@ class ContextTests(test_utils.DatastoreTest):
     key2 = model.Key('Foo', 2)
     ent1 = model.Expando(key=key1, foo=42, bar='hello')
     ent2 = model.Expando(key=key2, foo=1, bar='world')
-    save_add_multi = memcache.add_multi
+    save_cas_multi = memcache.Client.cas_multi
     try:
-      memcache.add_multi = tracking_add_multi
+      memcache.Client.cas_multi = tracking_cas_multi
       memcache.flush_all()
 
       track = []
@@ -273,8 +464,87 @@ class ContextTests(test_utils.DatastoreTest):
       self.assertEqual(len(track), 1)
       self.assertEqual(track[0][2], badkeys)
       memcache.flush_all()
+    finally:
+      memcache.Client.cas_multi = save_cas_multi
+
+  def testContext_MemcacheLease(self):
+    key = model.Key(flat=('Foo', 1))
+    self.ctx.put(model.Expando(key=key, foo=42)).check_success()
+    memcache.flush_all()
+    calls = []
+    ctxs = []
+    for i in range(10):
+      conn = model.make_connection(default_model=model.Expando)
+      def tracking_async_get(options, keys, save_async_get=conn.async_get):
+        calls.append(keys)
+        return save_async_get(options, keys)
+      conn.async_get = tracking_async_get
+      ctxs.append(context.Context(conn=conn))
+    @tasklets.tasklet
+    def reader(ctx):
+      ent = yield ctx.get(key, use_cache=False)
+      raise tasklets.Return(ent.foo)
+    @tasklets.tasklet
+    def foo():
+      # The first reader takes the lease; the rest wait for it to fill it.
+      results = yield [reader(ctx) for ctx in ctxs]
+      raise tasklets.Return(results)
+    self.assertEqual(foo().get_result(), [42] * 10)
+    self.assertEqual(calls, [[key]])
+
+  def testContext_MemcacheLeaseWrite(self):
+    key = model.Key(flat=('Foo', 1))
+    mkey = key.urlsafe()
+    self.ctx.put(model.Expando(key=key, foo=42)).check_success()
+    memcache.flush_all()
+    todo = [(tasklets.Future(), key, None)]
+    leftover, waiting, client, leases = self.ctx._memcache_get_tasklet(
+        todo, {key: mkey}, 0).get_result()
+    self.assertEqual(leftover, todo)
+    self.assertEqual(waiting, [])
+    self.assertEqual(leases.keys(), [mkey])
+    # A write while the lease is held deletes it, so the fill fails.
+    self.ctx.put(model.Expando(key=key, foo=43)).check_success()
+    client.cas_multi({mkey: model.Expando(key=key, foo=42)._to_pb()},
+                     key_prefix='NDB:')
+    self.assertEqual(memcache.get_multi([mkey], key_prefix='NDB:'), {})
+    # A key with nobody else's lease on it is leased by the next reader.
+    ent = self.ctx.get(key, use_cache=False).get_result()
+    self.assertEqual(ent.foo, 43)
+    self.assertEqual(memcache.get_multi([mkey], key_prefix='NDB:'),
+                     {mkey: ent._to_pb()})
+
+  def testContext_MemcacheLeaseOthers(self):
+    key1 = model.Key(flat=('Foo', 1))
+    key2 = model.Key(flat=('Foo', 2))
+    key3 = model.Key(flat=('Foo', 3))
+    memkeymap = dict((key, key.urlsafe()) for key in (key1, key2, key3))
+    # Another reader holds the lease on key2.
+    memcache.add(key2.urlsafe(), context._LEASE_VALUE, key_prefix='NDB:')
+    # And leases key3 between our get and our add.
+    save_add_multi = memcache.add_multi
+    def racing_add_multi(mapping, **kwds):
+      memcache.add(key3.urlsafe(), context._LEASE_VALUE, key_prefix='NDB:')
+      return save_add_multi(mapping, **kwds)
+    todo = [(tasklets.Future(), key, None) for key in (key1, key2, key3)]
+    try:
+      memcache.add_multi = racing_add_multi
+      leftover, waiting, client, leases = self.ctx._memcache_get_tasklet(
+          todo, memkeymap, 0).get_result()
     finally:
       memcache.add_multi = save_add_multi
+    # The plain miss is leased and returned at once, without polling.
+    self.assertEqual(leftover, todo[:1])
+    self.assertEqual(leases.keys(), [key1.urlsafe()])
+    # Both keys leased by others are left to poll, not read.
+    self.assertEqual(waiting, todo[1:])
+
+  def testContext_MemcacheLeaseMissing(self):
+    key = model.Key(flat=('Foo', 1))
+    self.assertEqual(self.ctx.get(key, use_cache=False).get_result(), None)
+    # The lease on a missing entity is released, not left to expire.
+    self.assertEqual(memcache.get_multi([key.urlsafe()], key_prefix='NDB:'),
+                     {})
 
   def testContext_CacheQuery(self):
     @tasklets.tasklet
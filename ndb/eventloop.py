@@ -10,7 +10,9 @@ enforcement of this requirement.
 The API here is inspired by Monocle.
 """
 
-import bisect
+import collections
+import heapq
+import itertools
 import logging
 import os
 import threading
@@ -30,26 +32,34 @@ FINISHING = RPC.FINISHING
 
 
 class EventLoop(object):
-  """An event loop."""
+  """An event loop.
 
-  # TODO: Use a separate queue for tasklets with delay=None.
+  Callbacks to be run as soon as possible (delay=None) are kept in a FIFO
+  deque, and run before any others. Timed callbacks are kept in a heap of
+  (when, sequence number, callable, args, kwds) tuples, where the sequence
+  number keeps callbacks due at the same time in the order they were queued.
+  """
 
   def __init__(self):
     """Constructor."""
-    self.queue = []
+    self.current = collections.deque()  # (callable, args, kwds) tuples
+    self.queue = []  # Heap of (when, seq, callable, args, kwds) tuples
+    self.counter = itertools.count()
     self.rpcs = {}
 
   # TODO: Rename to queue_callback?
   def queue_call(self, delay, callable, *args, **kwds):
     """Schedule a function call at a specific time in the future."""
     if delay is None:
-      when = 0
-    elif delay < 1e9:
+      self.current.append((callable, args, kwds))
+      return
+    if delay < 1e9:
       when = delay + time.time()
     else:
       # Times over a billion seconds are assumed to be absolute.
       when = delay
-    bisect.insort(self.queue, (when, callable, args, kwds))
+    heapq.heappush(self.queue,
+                   (when, self.counter.next(), callable, args, kwds))
 
   def queue_rpc(self, rpc, callable=None, *args, **kwds):
     """Schedule an RPC with an optional callback.
@@ -88,11 +98,17 @@ class EventLoop(object):
       A time to sleep if something happened (may be 0);
       None if all queues are empty.
     """
+    if self.current:
+      callable, args, kwds = self.current.popleft()
+      logging_debug('event: %s', callable.__name__)
+      callable(*args, **kwds)
+      # TODO: What if it raises an exception?
+      return 0
     delay = None
     if self.queue:
       delay = self.queue[0][0] - time.time()
-      if delay is None or delay <= 0:
-        when, callable, args, kwds = self.queue.pop(0)
+      if delay <= 0:
+        when, unused_seq, callable, args, kwds = heapq.heappop(self.queue)
         logging_debug('event: %s', callable.__name__)
         callable(*args, **kwds)
         # TODO: What if it raises an exception?
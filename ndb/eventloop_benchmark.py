@@ -0,0 +1,49 @@
+"""Microbenchmark for eventloop.py.
+
+Measures how many callbacks per second the event loop can queue and run,
+with different numbers of callbacks queued at once.
+
+Run from the application directory:
+
+  python -m ndb.eventloop_benchmark
+"""
+
+import time
+
+from . import eventloop
+
+SIZES = [10, 1000, 100000]  # Callbacks queued at once
+MIN_CALLBACKS = 200000  # Callbacks run per measurement, at least
+
+
+def noop():
+  pass
+
+
+def measure(size, delay):
+  """Returns callbacks/s for queueing size callbacks, then running them all.
+
+  Args:
+    size: The number of callbacks queued at once.
+    delay: The delay to queue them with; None for immediate callbacks.
+  """
+  ev = eventloop.EventLoop()
+  rounds = max(1, MIN_CALLBACKS // size)
+  start = time.time()
+  for i in xrange(rounds):
+    for j in xrange(size):
+      ev.queue_call(delay, noop)
+    while ev.run0() is not None:
+      pass
+  return rounds * size / (time.time() - start)
+
+
+def main():
+  print '%10s %16s %16s' % ('queued', 'immediate cb/s', 'timed cb/s')
+  for size in SIZES:
+    # Timed callbacks are given a delay that has already passed.
+    print '%10d %16d %16d' % (size, measure(size, None), measure(size, -1))
+
+
+if __name__ == '__main__':
+  main()
@@ -27,7 +27,8 @@ class EventLoopTests(test_utils.DatastoreTest):
     eventloop.queue_call(2, g, 100, 'abc')
     t_after = time.time()
     self.assertEqual(len(self.ev.queue), 3)
-    [(t1, f1, a1, k1), (t2, f2, a2, k2), (t3, f3, a3, k3)] = self.ev.queue
+    [(t1, s1, f1, a1, k1), (t2, s2, f2, a2, k2),
+     (t3, s3, f3, a3, k3)] = sorted(self.ev.queue)
     self.assertTrue(t1 < t2)
     self.assertTrue(t2 < t3)
     self.assertTrue(abs(t1 - (t_before + 1)) < t_after - t_before)
@@ -47,6 +48,37 @@ class EventLoopTests(test_utils.DatastoreTest):
     ev.queue = []
     ev.rpcs = {}
 
+  def testQueueImmediate(self):
+    def f(): return 1
+    eventloop.queue_call(None, f, 42, a=1)
+    eventloop.queue_call(1, f)
+    self.assertEqual(list(self.ev.current), [(f, (42,), {'a': 1})])
+    self.assertEqual(len(self.ev.queue), 1)
+    ev = eventloop.get_event_loop()
+    ev.current.clear()
+    ev.queue = []
+
+  def testRunImmediateFirstInOrder(self):
+    record = []
+    def foo(arg):
+      record.append(arg)
+    eventloop.queue_call(0, foo, 'timed')
+    for i in range(5):
+      eventloop.queue_call(None, foo, i)
+    eventloop.run()
+    self.assertEqual(record, [0, 1, 2, 3, 4, 'timed'])
+
+  def testRunStableOrder(self):
+    record = []
+    def foo(arg):
+      record.append(arg)
+    when = time.time() + 0.1
+    for i in range(5):
+      eventloop.queue_call(when, foo, i)
+    eventloop.queue_call(when - 0.05, foo, 'earlier')
+    eventloop.run()
+    self.assertEqual(record, ['earlier', 0, 1, 2, 3, 4])
+
   def testRun(self):
     record = []
     def foo(arg):
@@ -344,7 +344,23 @@ class ModelAdapter(datastore_rpc.AbstractAdapter):
   def key_to_pb(self, key):
     return key.reference()
 
-  def pb_to_entity(self, pb):
+  def pb_to_query_result(self, pb, query_options):
+    """Turns an entity_pb.EntityProto into a query result.
+
+    Batches are converted as their RPCs complete, whichever tasklet is
+    running then, so this goes by the options of the query the batch
+    belongs to: the lazy option makes the entity lazy (see
+    Model._from_pb()), and the raw option of Query.export() leaves the
+    protobuf unconverted.
+    """
+    if query_options.keys_only:
+      return self.pb_to_key(pb.key())
+    if getattr(query_options, 'raw', None):
+      return pb
+    return self.pb_to_entity(pb,
+                             lazy=bool(getattr(query_options, 'lazy', None)))
+
+  def pb_to_entity(self, pb, lazy=False):
     kind = None
     if pb.has_key():
       # TODO: Fix the inefficiency here: we extract the key just so we
@@ -355,7 +371,7 @@ class ModelAdapter(datastore_rpc.AbstractAdapter):
     modelclass = Model._kind_map.get(kind, self.default_model)
     if modelclass is None:
       raise KindError("No implementation found for kind '%s'" % kind)
-    entity = modelclass._from_pb(pb)
+    entity = modelclass._from_pb(pb, lazy=lazy)
     if self.want_pbs:
       entity._orig_pb = pb
     return entity
@@ -375,6 +391,19 @@ def make_connection(config=None, default_model=None):
       config=config)
 
 
+class _LazyValue(object):
+  """The protobuf properties for a value that hasn't been decoded yet.
+
+  Model._from_pb(pb, lazy=True) stores these in entity._values, and
+  Property._retrieve_value() replaces them with the decoded value.
+  """
+
+  __slots__ = ['plist']
+
+  def __init__(self, p):
+    self.plist = [p]  # Property Message objects (protocol buffers)
+
+
 class Property(object):
   """A class describing a typed, persisted attribute of a datastore entity.
 
@@ -648,6 +677,16 @@ class Property(object):
     This returns None if no value is set.  For a repeated Property
     this returns a list if a value is set, otherwise None.
     """
+    value = entity._values.get(self._name, self._default)
+    if value.__class__ is _LazyValue:
+      value = self._decode_lazy_value(entity, value)
+    return value
+
+  def _decode_lazy_value(self, entity, lazy_value):
+    """Internal helper to decode a value left undecoded by _from_pb()."""
+    del entity._values[self._name]
+    for p in lazy_value.plist:
+      self._deserialize(entity, p)
     return entity._values.get(self._name, self._default)
 
   def _get_value(self, entity):
@@ -1663,6 +1702,160 @@ class ComputedProperty(GenericProperty):
     pass
 
 
+def _set_int64(v, p, value):
+  v.set_int64value(value)
+
+
+def _get_int64(v, p):
+  if not v.has_int64value():
+    return None
+  return int(v.int64value())
+
+
+def _set_double(v, p, value):
+  v.set_doublevalue(float(value))
+
+
+def _get_double(v, p):
+  if not v.has_doublevalue():
+    return None
+  return v.doublevalue()
+
+
+def _set_datetime(v, p, value):
+  dt = value - _EPOCH
+  v.set_int64value(dt.microseconds + 1000000 * (dt.seconds + 24*3600 * dt.days))
+  p.set_meaning(entity_pb.Property.GD_WHEN)
+
+
+def _get_datetime(v, p):
+  if not v.has_int64value():
+    return None
+  return _EPOCH + datetime.timedelta(microseconds=v.int64value())
+
+
+def _set_blobkey(v, p, value):
+  p.set_meaning(entity_pb.Property.BLOBKEY)
+  v.set_stringvalue(str(value))
+
+
+def _get_blobkey(v, p):
+  if not v.has_stringvalue():
+    return None
+  return datastore_types.BlobKey(v.stringvalue())
+
+
+# Maps Property classes to (setter, getter) pairs with the same effect as
+# their _db_set_value() and _db_get_value() methods, minus the asserts.
+# Subclasses aren't included, since they may override either method.
+_FAST_PROPERTY_CODECS = {
+  IntegerProperty: (_set_int64, _get_int64),
+  FloatProperty: (_set_double, _get_double),
+  DateTimeProperty: (_set_datetime, _get_datetime),
+  BlobKeyProperty: (_set_blobkey, _get_blobkey),
+}
+
+
+class _ModelCodec(object):
+  """Conversions between a Model class's entities and protobufs.
+
+  This is built once per class, from its properties, by Model._get_codec().
+  Properties of the types in _FAST_PROPERTY_CODECS that aren't repeated
+  (and, for DateTimeProperty, don't set auto_now or auto_now_add) are
+  converted by closures holding everything needed; the rest by their own
+  _serialize() and _deserialize() methods.  Either way, the protobufs are
+  the same as those made by calling _serialize() for every property.
+
+  Entities with properties of their own (such as Expandos with dynamic
+  properties) can't use the codec to serialize.
+  """
+
+  def __init__(self, properties):
+    self.encoders = []  # One per property, in name order.
+    self.decoders = {}  # Maps protobuf property names to decoders.
+    self.lazy_names = set()  # Names of properties that may be left lazy.
+    for name, prop in sorted(properties.iteritems()):
+      if not isinstance(prop, (StructuredProperty, ComputedProperty)):
+        self.lazy_names.add(prop._name)
+      codec = _FAST_PROPERTY_CODECS.get(prop.__class__)
+      if (codec is None or prop._repeated or
+          getattr(prop, '_auto_now', False) or
+          getattr(prop, '_auto_now_add', False)):
+        self.encoders.append(prop._serialize)
+        if not isinstance(prop, StructuredProperty):
+          self.decoders[prop._name] = prop._deserialize
+      else:
+        setter, getter = codec
+        self.encoders.append(self._make_encoder(prop, setter))
+        self.decoders[prop._name] = self._make_decoder(prop, getter)
+
+  @staticmethod
+  def _make_encoder(prop, setter):
+    name = prop._name
+    indexed = prop._indexed
+    default = prop._default
+    retrieve_value = prop._retrieve_value
+    def encode(entity, pb):
+      value = entity._values.get(name, default)
+      if value.__class__ is _LazyValue:
+        value = retrieve_value(entity)
+      if indexed:
+        p = pb.add_property()
+      else:
+        p = pb.add_raw_property()
+      p.set_name(name)
+      p.set_multiple(False)
+      v = p.mutable_value()
+      if value is not None:
+        setter(v, p, value)
+    return encode
+
+  @staticmethod
+  def _make_decoder(prop, getter):
+    name = prop._name
+    deserialize = prop._deserialize
+    def decode(entity, p):
+      values = entity._values
+      if name in values:
+        # Seen before, so let _deserialize() merge the values.
+        deserialize(entity, p)
+      else:
+        values[name] = getter(p.value(), p)
+    return decode
+
+  def serialize(self, entity, pb):
+    """Add entity's property values to pb, an EntityProto."""
+    for encode in self.encoders:
+      encode(entity, pb)
+
+  def deserialize(self, entity, pb, lazy=False):
+    """Set entity's property values from pb, an EntityProto.
+
+    If lazy is True, the class's properties are left undecoded, as
+    _LazyValue instances, until they are first accessed.
+    """
+    decoders = self.decoders
+    lazy_names = self.lazy_names if lazy else ()
+    values = entity._values
+    for plist, indexed in ((pb.property_list(), True),
+                           (pb.raw_property_list(), False)):
+      for p in plist:
+        name = p.name()
+        if name in lazy_names:
+          value = values.get(name)
+          if value.__class__ is _LazyValue:
+            value.plist.append(p)
+            continue
+          if name not in values:
+            values[name] = _LazyValue(p)
+            continue
+        decode = decoders.get(name)
+        if decode is None:
+          prop = entity._get_property_for(p, indexed)
+          decode = prop._deserialize
+        decode(entity, p)
+
+
 class MetaModel(type):
   """Metaclass for Model.
 
@@ -1708,6 +1901,8 @@ class Model(object):
   _properties = None
   _has_repeated = False
   _kind_map = {}  # Dict mapping {kind: Model subclass}
+  _codec = None  # A _ModelCodec, made on first use by _get_codec()
+  _lazy = False  # Set to True to always decode properties on first access
 
   # Defaults for instance variables.
   _key = None
@@ -1910,14 +2105,23 @@ class Model(object):
         if elem.id() or elem.name():
           group.add_element().CopyFrom(elem)
 
-    for name, prop in sorted(self._properties.iteritems()):
-      prop._serialize(self, pb)
+    if self._properties is self.__class__._properties:
+      self._get_codec().serialize(self, pb)
+    else:
+      for name, prop in sorted(self._properties.iteritems()):
+        prop._serialize(self, pb)
 
     return pb
 
   @classmethod
-  def _from_pb(cls, pb, set_key=True, ent=None):
-    """Internal helper to create an entity from an EntityProto protobuf."""
+  def _from_pb(cls, pb, set_key=True, ent=None, lazy=False):
+    """Internal helper to create an entity from an EntityProto protobuf.
+
+    If lazy is True, or the class sets _lazy, the values of the properties
+    the class declares are decoded when they are first accessed rather than
+    now.  This saves time for entities of which only a few properties are
+    used, such as in large query results.
+    """
     assert isinstance(pb, entity_pb.EntityProto)
     if ent is None:
       ent = cls()
@@ -1928,15 +2132,18 @@ class Model(object):
       if set_key or key.id() or key.parent():
         ent._key = key
 
-    indexed_properties = pb.property_list()
-    unindexed_properties = pb.raw_property_list()
-    for plist in [indexed_properties, unindexed_properties]:
-      for p in plist:
-        prop = ent._get_property_for(p, plist is indexed_properties)
-        prop._deserialize(ent, p)
+    cls._get_codec().deserialize(ent, pb, lazy or cls._lazy)
 
     return ent
 
+  @classmethod
+  def _get_codec(cls):
+    """Internal helper to return the _ModelCodec for this class."""
+    codec = cls.__dict__.get('_codec')
+    if codec is None:
+      codec = cls._codec = _ModelCodec(cls._properties)
+    return codec
+
   def _get_property_for(self, p, indexed=True, depth=0):
     """Internal helper to get the Property for a protobuf-level property."""
     name = p.name()
@@ -1987,6 +2194,7 @@ class Model(object):
                         'a Unicode string (%r); please encode using utf-8' %
                         (cls.__name__, kind))
     cls._properties = {}  # Map of {name: Property}
+    cls._codec = None
     if cls.__module__ == __name__:  # Skip the classes in *this* file.
       return
     for name in set(dir(cls)):
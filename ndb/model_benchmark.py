@@ -0,0 +1,75 @@
+"""Microbenchmark for converting entities to and from protobufs.
+
+Compares Model._to_pb() and Model._from_pb(), which use the model's
+_ModelCodec, with calling each Property's _serialize() and _deserialize()
+in turn, for a model like CachedTile with mostly simple properties.
+
+Run from the application directory, with the App Engine SDK on the path:
+
+  python -m ndb.model_benchmark
+"""
+
+import datetime
+import time
+
+from google.appengine.api import datastore_types
+
+from . import model
+
+COUNT = 20000  # Conversions per measurement
+
+
+class Tile(model.Model):
+  level = model.IntegerProperty()
+  x = model.IntegerProperty()
+  y = model.IntegerProperty()
+  limit = model.IntegerProperty(indexed=False)
+  cost = model.FloatProperty(indexed=False)
+  image = model.BlobKeyProperty()
+  created = model.DateTimeProperty()
+  name = model.StringProperty()
+
+
+def to_pb_per_property(ent):
+  pb = ent._to_pb()  # For the key; the properties are redone below.
+  pb.clear_property()
+  pb.clear_raw_property()
+  for name, prop in sorted(ent._properties.iteritems()):
+    prop._serialize(ent, pb)
+  return pb
+
+
+def from_pb_per_property(pb):
+  ent = Tile()
+  ent._key = model.Key(reference=pb.key())
+  for plist, indexed in ((pb.property_list(), True),
+                         (pb.raw_property_list(), False)):
+    for p in plist:
+      ent._get_property_for(p, indexed)._deserialize(ent, p)
+  return ent
+
+
+def measure(func, arg):
+  """Returns calls/s for calling func(arg) COUNT times."""
+  start = time.time()
+  for i in xrange(COUNT):
+    func(arg)
+  return COUNT / (time.time() - start)
+
+
+def main():
+  ent = Tile(key=model.Key(Tile, 'tile-3-1-2'), level=3, x=1, y=2, limit=256,
+             cost=123456.0, image=datastore_types.BlobKey('blob-key'),
+             created=datetime.datetime(2011, 7, 1, 12, 0, 0), name='tile')
+  pb = ent._to_pb()
+  assert to_pb_per_property(ent).Equals(pb)
+  assert from_pb_per_property(pb) == Tile._from_pb(pb)
+  print '%10s %16s %16s' % ('', 'per-property/s', 'codec/s')
+  print '%10s %16d %16d' % ('to_pb', measure(to_pb_per_property, ent),
+                            measure(Tile._to_pb, ent))
+  print '%10s %16d %16d' % ('from_pb', measure(from_pb_per_property, pb),
+                            measure(Tile._from_pb, pb))
+
+
+if __name__ == '__main__':
+  main()
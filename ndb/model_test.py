@@ -1453,6 +1453,89 @@ class ModelTests(test_utils.DatastoreTest):
     q = Person._from_pb(pb)
     self.assertEqual(p.t, q.t)
 
+  def testCodecRoundTrip(self):
+    class Tile(model.Model):
+      a = model.IntegerProperty()
+      b = model.FloatProperty(indexed=False)
+      c = model.DateTimeProperty()
+      d = model.BlobKeyProperty()
+      e = model.IntegerProperty(repeated=True)
+      f = model.StringProperty()
+      g = model.DateTimeProperty(auto_now_add=True)
+      h = model.DateProperty()
+      i = model.IntegerProperty(default=7)
+    ent = Tile(key=model.Key(Tile, 42), a=1, b=2.5,
+               c=datetime.datetime(1982, 12, 1, 9, 0, 0, 500),
+               d=datastore_types.BlobKey('testkey123'), e=[1, 2], f=u'\u1234',
+               h=datetime.date(1995, 4, 15))
+    self.assertTrue(Tile._get_codec().decoders['a'] is not Tile.a._deserialize)
+    pb = ent._to_pb()
+    # The same as serializing each property in turn.
+    expected = entity_pb.EntityProto()
+    expected.CopyFrom(pb)
+    expected.clear_property()
+    expected.clear_raw_property()
+    for name, prop in sorted(Tile._properties.iteritems()):
+      prop._serialize(ent, expected)
+    self.assertEqual(str(pb), str(expected))
+    self.assertEqual(Tile._from_pb(pb), ent)
+    # Unset properties come back as None or their default.
+    pb = Tile(key=model.Key(Tile, 43))._to_pb()
+    ent = Tile._from_pb(pb)
+    self.assertEqual(ent.a, None)
+    self.assertEqual(ent.c, None)
+    self.assertEqual(ent.i, 7)
+
+  def testCodecMergesValues(self):
+    class Tile(model.Model):
+      a = model.IntegerProperty()
+    pb = Tile(a=1)._to_pb()
+    p = pb.add_property()
+    p.set_name('a')
+    p.set_multiple(False)
+    p.mutable_value().set_int64value(2)
+    # A non-repeated property seen twice becomes a list, as without a codec.
+    self.assertEqual(Tile._from_pb(pb)._values['a'], [1, 2])
+
+  def testCodecExpando(self):
+    class Ex(model.Expando):
+      a = model.IntegerProperty()
+    ex = Ex(a=1)
+    ex.b = 2.5  # Dynamic properties bypass the codec.
+    ex2 = Ex._from_pb(ex._to_pb())
+    self.assertEqual(ex2.a, 1)
+    self.assertEqual(ex2.b, 2.5)
+    self.assertEqual(Ex()._to_pb().property_size(), 1)
+
+  def testLazyFromPb(self):
+    class Tile(model.Model):
+      a = model.IntegerProperty()
+      b = model.StringProperty(repeated=True)
+      c = model.TextProperty(compressed=True)
+    ent = Tile(key=model.Key(Tile, 42), a=1, b=['x', 'y'], c=u'hello')
+    pb = ent._to_pb()
+    lazy = Tile._from_pb(pb, lazy=True)
+    self.assertEqual(set(lazy._values), set(['a', 'b', 'c']))
+    self.assertEqual(lazy.b, ['x', 'y'])
+    self.assertEqual(lazy._values['b'], ['x', 'y'])
+    self.assertTrue(isinstance(lazy._values['a'], model._LazyValue))
+    self.assertEqual(lazy, ent)
+    # Re-serializing decodes anything still undecoded.
+    self.assertEqual(str(Tile._from_pb(pb, lazy=True)._to_pb()), str(pb))
+    lazy = Tile._from_pb(pb, lazy=True)
+    lazy.a = 2  # Setting a value replaces the undecoded one.
+    self.assertEqual(lazy.a, 2)
+
+  def testLazyModel(self):
+    class Tile(model.Model):
+      _lazy = True
+      a = model.IntegerProperty()
+    ent = Tile(a=1)
+    ent.put()
+    ent2 = ent.key.get(use_cache=False, use_memcache=False)
+    self.assertTrue(isinstance(ent2._values['a'], model._LazyValue))
+    self.assertEqual(ent2.a, 1)
+
   def testExpandoKey(self):
     class Ex(model.Expando):
       pass
@@ -80,10 +80,12 @@ Some other methods to run a query and access its results:
 
   q.iter() # Return an iterator; same as iter(q) but more flexible
   q.map(callback) # Call the callback function for each query result
+  q.map_parallel(callback, shards=N) # Same, over N key ranges at once
   q.fetch(N) # Return a list of the first N results
   q.get() # Return the first result
   q.count(N) # Return the number of results, with a maximum of N
   q.fetch_page(N, start_cursor=cursor) # Return (results, cursor, has_more)
+  q.export(checkpoint=func) # Generate all results, a batch at a time
 
 All of the above methods take a standard set of additional query
 options, either in the form of keyword arguments such as
@@ -98,6 +100,7 @@ options=QueryOptions(...).  The most important query options are:
   batch_size: int, hint for the number of results returned per RPC
   prefetch_size: int, hint for the number of results in the first RPC
   produce_cursors: bool, return Cursor objects with the results
+  lazy: bool, decode each entity's properties when first accessed
 
 For additional (obscure) query options and more details on them,
 including an explanation of Cursors, see datastore_query.py.
@@ -145,7 +148,6 @@ __all__ = ['Binding', 'AND', 'OR', 'parse_gql', 'Query',
            'QueryOptions', 'Cursor']
 
 # Re-export some useful classes from the lower-level module.
-QueryOptions = datastore_query.QueryOptions
 Cursor = datastore_query.Cursor
 
 # Some local renamings.
@@ -157,9 +159,38 @@ _KEY = datastore_types._KEY_SPECIAL_PROPERTY
 # Table of supported comparison operators.
 _OPS = frozenset(['=', '!=', '<', '<=', '>', '>=', 'in'])
 
+
+class QueryOptions(datastore_query.QueryOptions):
+  """Options for running a query; see the module docstring."""
+
+  @datastore_rpc.ConfigOption
+  def lazy(value):
+    if not isinstance(value, bool):
+      raise datastore_errors.BadArgumentError(
+        'lazy should be a bool (%r)' % (value,))
+    return value
+
+
+class _ExportOptions(QueryOptions):
+  """QueryOptions for Query.export(), adding its raw option."""
+
+  @datastore_rpc.ConfigOption
+  def raw(value):
+    if not isinstance(value, bool):
+      raise datastore_errors.BadArgumentError(
+        'raw should be a bool (%r)' % (value,))
+    return value
+
+
 # Default limit value.  (Yes, the datastore uses int32!)
 _MAX_LIMIT = 2**31 - 1
 
+# Keys sampled per shard to choose map_parallel()'s key ranges.
+_SCATTER_OVERSAMPLE = 32
+
+# Default batch size for export().
+_EXPORT_BATCH_SIZE = 100
+
 
 # TODO: Once CL/21689469 is submitted, get rid of this and its callers.
 def _make_unsorted_key_value_map(pb, property_names):
@@ -681,7 +712,21 @@ class Query(object):
       args.append('orders=...')  # PropertyOrder doesn't have a good repr().
     return '%s(%s)' % (self.__class__.__name__, ', '.join(args))
 
-  def _get_query(self, connection):
+  def _resolve_filters(self):
+    """Return the filters with any IN Bindings expanded, or None.
+
+    The result is passed to both _maybe_multi_query() and _get_query(),
+    so the tree is only normalized once per run.
+    """
+    filters = self.__filters
+    if filters is not None:
+      filters = filters.resolve()
+    return filters
+
+  def _get_query(self, connection, filters):
+    # This is built afresh for every run.  Each datastore_query filter
+    # embeds its value, so there is no value-independent compiled form
+    # that a cache keyed by query shape could reuse.
     kind = self.__kind
     ancestor = self.__ancestor
     bindings = {}
@@ -690,7 +735,6 @@ class Query(object):
       ancestor = ancestor.resolve()
     if ancestor is not None:
       ancestor = connection.adapter.key_to_pb(ancestor)
-    filters = self.__filters
     post_filters = None
     if filters is not None:
       post_filters = filters._post_filters()
@@ -709,13 +753,14 @@ class Query(object):
   def run_to_queue(self, queue, conn, options=None, dsquery=None):
     """Run this query, putting entities into the given queue."""
     try:
-      multiquery = self._maybe_multi_query()
+      filters = self._resolve_filters()
+      multiquery = self._maybe_multi_query(filters)
       if multiquery is not None:
         yield multiquery.run_to_queue(queue, conn, options=options)
         return
 
       if dsquery is None:
-        dsquery = self._get_query(conn)
+        dsquery = self._get_query(conn, filters)
       orig_options = options
       rpc = dsquery.run_async(conn, options)
       skipped = 0
@@ -733,18 +778,15 @@ class Query(object):
         queue.set_exception(e, tb)
       raise
 
-  def _maybe_multi_query(self):
-    filters = self.__filters
-    if filters is not None:
-      filters = filters.resolve()
-      if isinstance(filters, DisjunctionNode):
-        # Switch to a _MultiQuery.
-        subqueries = []
-        for subfilter in filters:
-          subquery = Query(kind=self.__kind, ancestor=self.__ancestor,
-                           filters=subfilter, orders=self.__orders)
-          subqueries.append(subquery)
-        return _MultiQuery(subqueries)
+  def _maybe_multi_query(self, filters):
+    if isinstance(filters, DisjunctionNode):
+      # Switch to a _MultiQuery.
+      subqueries = []
+      for subfilter in filters:
+        subquery = Query(kind=self.__kind, ancestor=self.__ancestor,
+                         filters=subfilter, orders=self.__orders)
+        subqueries.append(subquery)
+      return _MultiQuery(subqueries)
     return None
 
   @property
@@ -871,6 +913,98 @@ class Query(object):
                                             options=_make_options(q_options),
                                             merge_future=merge_future)
 
+  @datastore_rpc._positional(2)
+  def map_parallel(self, callback, shards=4, ordered=False, **q_options):
+    """Map a callback function or tasklet over the query results in shards.
+
+    The key range of the query's kind is split into up to shards ranges
+    of roughly equal size, using the datastore's __scatter__ sample of
+    keys, and a query for each range runs at the same time.  Each shard
+    calls the callback for one result at a time, waiting for it if it
+    returns a Future, so at most shards callbacks run at once.  If the
+    kind has too few entities to split, fewer shards are used.
+
+    The query may not have sort orders or inequality filters, since each
+    shard adds an inequality filter on the key.  The limit, offset and
+    produce_cursors options aren't supported either.
+
+    Args:
+      callback: A function or tasklet to be applied to each result; it is
+        called with an entity, or with a Key if keys_only=True is given.
+      shards: The most queries to run at once.
+      ordered: If True, return the results in key order.  Otherwise
+        each shard's results are in no particular order.
+      **q_options: All other query options keyword arguments are supported.
+
+    Returns:
+      A list of the results of all callbacks, shard by shard.
+    """
+    return self.map_parallel_async(callback, shards=shards, ordered=ordered,
+                                   **q_options).get_result()
+
+  @tasklets.tasklet
+  @datastore_rpc._positional(2)
+  def map_parallel_async(self, callback, shards=4, ordered=False,
+                         **q_options):
+    """Map a callback function or tasklet over the query results in shards.
+
+    This is the asynchronous version of Query.map_parallel().
+    """
+    if self.orders is not None:
+      raise datastore_errors.BadArgumentError(
+          'map_parallel() does not support sort orders')
+    for name in 'limit', 'offset', 'produce_cursors':
+      if q_options.get(name):
+        raise datastore_errors.BadArgumentError(
+            'map_parallel() does not support %s' % name)
+    # The shards add inequality filters on the key, and the datastore
+    # allows inequalities on only one property per query.
+    for name in _inequality_properties(self.filters):
+      if name != _KEY:
+        raise datastore_errors.BadArgumentError(
+            'map_parallel() does not support inequality filters on %s' % name)
+    splits = yield self._get_split_keys_async(shards)
+    bounds = [None] + splits + [None]
+    shard_futures = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+      q = self
+      if lo is not None:
+        q = q.filter(model.Model.key >= lo)
+      if hi is not None:
+        q = q.filter(model.Model.key < hi)
+      if ordered:
+        q = q.order(model.Model.key)
+      shard_futures.append(_map_serially(q, callback, q_options))
+    shard_results = yield shard_futures
+    raise tasklets.Return(list(itertools.chain.from_iterable(shard_results)))
+
+  @tasklets.tasklet
+  def _get_split_keys_async(self, shards):
+    """Return sorted keys splitting this query's kind into shards ranges.
+
+    The keys come from a keys-only query ordered by __scatter__, a property
+    the datastore sets on a random sample of entities.  There are fewer
+    than shards - 1 keys if the sample is too small (or the datastore
+    doesn't support __scatter__).
+    """
+    if shards <= 1:
+      raise tasklets.Return([])
+    q = Query(kind=self.kind, ancestor=self.ancestor)
+    q = q.order(datastore_query.PropertyOrder('__scatter__'))
+    try:
+      keys = yield q.fetch_async(shards * _SCATTER_OVERSAMPLE, keys_only=True)
+    except datastore_errors.BadRequestError:
+      keys = []
+    keys.sort(key=_key_order)
+    if len(keys) < shards:
+      raise tasklets.Return(keys)
+    splits = []
+    for i in xrange(1, shards):
+      key = keys[i * len(keys) // shards]
+      if not splits or key != splits[-1]:
+        splits.append(key)
+    raise tasklets.Return(splits)
+
   @datastore_rpc._positional(2)
   def fetch(self, limit=None, **q_options):
     """Fetch a list of query results, up to a limit.
@@ -960,8 +1094,8 @@ class Query(object):
     assert 'limit' not in q_options, q_options
     if limit is None:
       limit = _MAX_LIMIT
-    if (self.__filters is not None and
-        isinstance(self.__filters, DisjunctionNode)):
+    filters = self._resolve_filters()
+    if isinstance(filters, DisjunctionNode):
       # _MultiQuery does not support iterating over result batches,
       # so just fetch results and count them.
       # TODO: Use QueryIterator to avoid materializing the results list.
@@ -978,7 +1112,7 @@ class Query(object):
     q_options['limit'] = 0
     options = _make_options(q_options)
     conn = tasklets.get_context()._conn
-    dsquery = self._get_query(conn)
+    dsquery = self._get_query(conn, filters)
     rpc = dsquery.run_async(conn, options)
     total = 0
     while rpc is not None:
@@ -1014,6 +1148,53 @@ class Query(object):
     # NOTE: page_size can't be passed as a keyword.
     return self.fetch_page_async(page_size, **q_options).get_result()
 
+  @datastore_rpc._positional(1)
+  def export(self, raw=False, checkpoint=None, checkpoint_interval=1,
+             **q_options):
+    """Generate the query results, holding at most two batches in memory.
+
+    This is a generator, for exporting queries with too many results to
+    fetch() at once.  While the caller processes one batch, the next one
+    is being fetched.  The results come straight from the datastore,
+    bypassing the Context's cache.
+
+    Queries using the IN, != or OR operators are not supported.
+
+    Args:
+      raw: If True, generate EntityProto protobufs instead of entities.
+      checkpoint: Optional function that is called with a Cursor once the
+        caller has processed every checkpoint_interval batches, and after
+        the last one.  Passing it as start_cursor resumes after them.
+      checkpoint_interval: The number of batches between checkpoints.
+      **q_options: All query options keyword arguments are supported.
+        batch_size defaults to _EXPORT_BATCH_SIZE.
+    """
+    filters = self._resolve_filters()
+    if self._maybe_multi_query(filters) is not None:
+      raise datastore_errors.BadArgumentError(
+          'export() does not support the IN, != or OR operators')
+    q_options.setdefault('batch_size', _EXPORT_BATCH_SIZE)
+    if checkpoint is not None:
+      q_options['produce_cursors'] = True
+    options = _make_options(q_options)
+    if raw:
+      # The adapter then leaves each result as its protobuf.
+      options = _ExportOptions(raw=True, config=options)
+    conn = tasklets.get_context()._conn
+    dsquery = self._get_query(conn, filters)
+    rpc = dsquery.run_async(conn, options)
+    count = 0
+    while rpc is not None:
+      batch = _get_batch_async(rpc).get_result()
+      # Start fetching the next batch before returning this one.
+      rpc = batch.next_batch_async(options)
+      for result in batch.results:
+        yield result
+      count += 1
+      if checkpoint is not None and (rpc is None or
+                                     count % checkpoint_interval == 0):
+        checkpoint(batch.cursor(len(batch.results)))
+
   @tasklets.tasklet
   @datastore_rpc._positional(2)
   def fetch_page_async(self, page_size, **q_options):
@@ -1036,6 +1217,50 @@ class Query(object):
     raise tasklets.Return(results, cursor, it.probably_has_next())
 
 
+@tasklets.tasklet
+def _get_batch_async(rpc):
+  """Helper for export() to wait for a batch of results on the event loop."""
+  batch = yield rpc
+  raise tasklets.Return(batch)
+
+
+@tasklets.tasklet
+def _map_serially(query, callback, q_options):
+  """Helper for map_parallel_async() to run one shard's query."""
+  results = []
+  it = query.iter(**q_options)
+  while (yield it.has_next_async()):
+    val = callback(it.next())
+    if isinstance(val, tasklets.Future):
+      val = yield val
+    results.append(val)
+  raise tasklets.Return(results)
+
+
+def _inequality_properties(node):
+  """Return the names of properties that node filters by inequality."""
+  if isinstance(node, FilterNode):
+    name, opsymbol, _ = node._sort_key()
+    if opsymbol in ('<', '<=', '>', '>='):
+      return set([name])
+    return set()
+  names = set()
+  if isinstance(node, (ConjunctionNode, DisjunctionNode)):
+    for child in node:
+      names.update(_inequality_properties(child))
+  return names
+
+
+def _key_order(key):
+  """Return a value that sorts keys in the datastore's order.
+
+  Keys are compared path element by path element: by kind, then with
+  integer ids before string names.
+  """
+  return tuple((kind, isinstance(id, basestring), id)
+               for kind, id in key.pairs())
+
+
 def _make_options(q_options):
   """Helper to construct a QueryOptions object from keyword arguents.
 
@@ -1368,7 +1593,7 @@ class _MultiQuery(object):
       # Start running all the sub-queries.
       todo = []  # List of (subit, dsquery) tuples.
       for subq in self.__subqueries:
-        dsquery = subq._get_query(conn)
+        dsquery = subq._get_query(conn, subq.filters)
         subit = tasklets.SerialQueueFuture('_MultiQuery.run_to_queue[par]')
         subq.run_to_queue(subit, conn, options=options, dsquery=dsquery)
         todo.append((subit, dsquery))
@@ -12,6 +12,7 @@ from google.appengine.api import datastore_file_stub
 from google.appengine.api.memcache import memcache_stub
 from google.appengine.datastore import datastore_rpc
 from google.appengine.datastore import datastore_query
+from google.appengine.datastore import entity_pb
 
 from . import context
 from . import model
@@ -343,6 +344,54 @@ class QueryTests(test_utils.DatastoreTest):
       self.assertEqual(res, ['jill', 'joe'])
     foo()
 
+  def testMapParallel(self):
+    q = query.Query(kind='Foo').filter(Foo.rate == 1)
+    res = q.map_parallel(lambda ent: ent.name, shards=3)
+    self.assertEqual(sorted(res), ['joe', 'moe'])
+    self.assertRaises(datastore_errors.BadArgumentError,
+                      q.order(Foo.name).map_parallel, None)
+    self.assertRaises(datastore_errors.BadArgumentError,
+                      q.map_parallel, None, limit=1)
+    self.assertRaises(datastore_errors.BadArgumentError,
+                      q.filter(Foo.name > 'jill').map_parallel, None)
+    self.assertRaises(datastore_errors.BadArgumentError,
+                      q.filter(Foo.name != 'jill').map_parallel, None)
+    q = q.filter(model.Model.key > self.joe.key)
+    res = q.map_parallel(lambda ent: ent.name, shards=3)
+    self.assertEqual(res, ['moe'])
+
+  def testMapParallelShards(self):
+    keys = sorted([self.joe.key, self.jill.key, self.moe.key],
+                  key=query._key_order)
+    @tasklets.tasklet
+    def get_split_keys_async(q, shards):
+      self.assertEqual(shards, 2)
+      raise tasklets.Return(keys[2:])
+    running = []
+    @tasklets.tasklet
+    def callback(key):
+      running.append(key)
+      self.assertTrue(len(running) <= 2)  # One per shard.
+      yield tasklets.sleep(0.01)
+      running.remove(key)
+      raise tasklets.Return(key)
+    save_get_split_keys_async = query.Query._get_split_keys_async
+    try:
+      query.Query._get_split_keys_async = get_split_keys_async
+      q = query.Query(kind='Foo')
+      res = q.map_parallel(callback, shards=2, ordered=True, keys_only=True)
+      self.assertEqual(res, keys)
+    finally:
+      query.Query._get_split_keys_async = save_get_split_keys_async
+
+  def testKeyOrder(self):
+    self.assertTrue(query._key_order(model.Key('Foo', 2)) <
+                    query._key_order(model.Key('Foo', 'a')))
+    self.assertTrue(query._key_order(model.Key('Foo', 1)) <
+                    query._key_order(model.Key('Foo', 1, 'Bar', 1)))
+    self.assertTrue(query._key_order(model.Key('Bar', 'z')) <
+                    query._key_order(model.Key('Foo', 1)))
+
   def testFetch(self):
     q = query.Query(kind='Foo').filter(Foo.tags == 'jill').order(Foo.name)
     self.assertEqual(q.fetch(10), [self.jill, self.joe])
@@ -361,6 +410,32 @@ class QueryTests(test_utils.DatastoreTest):
       self.assertEqual(res, [self.jill])
     foo()
 
+  def testFetchLazy(self):
+    tasklets.get_context().clear_cache()  # Otherwise the results are cached.
+    q = query.Query(kind='Foo').filter(Foo.tags == 'jill').order(Foo.name)
+    res = q.fetch(10, lazy=True)
+    self.assertTrue(isinstance(res[0]._values['name'], model._LazyValue))
+    self.assertEqual(res[0].name, 'jill')
+    self.assertEqual(res[0]._values['name'], 'jill')
+    self.assertTrue(isinstance(res[0]._values['rate'], model._LazyValue))
+    self.assertEqual(res, [self.jill, self.joe])
+    self.assertEqual(res[1].tags, ['joe', 'jill', 'hello'])
+    res = q.fetch(10, options=query.QueryOptions(lazy=False))
+    self.assertEqual(res[0]._values['name'], 'jill')
+
+  def testFetchLazyConcurrent(self):
+    # Each batch goes by its own query's options, even when their RPCs
+    # complete while another query is waiting.
+    tasklets.get_context().clear_cache()
+    q = query.Query(kind='Foo').order(Foo.name)
+    lazy_fut = q.fetch_async(10, lazy=True)
+    eager_fut = q.fetch_async(10)
+    lazy = lazy_fut.get_result()
+    eager = eager_fut.get_result()
+    self.assertTrue(isinstance(lazy[0]._values['name'], model._LazyValue))
+    self.assertEqual(eager[0]._values['name'], 'jill')
+    self.assertEqual(lazy, eager)
+
   def testFetchEmpty(self):
     q = query.Query(kind='Foo').filter(Foo.tags == 'jillian')
     self.assertEqual(q.fetch(1), [])
@@ -401,6 +476,42 @@ class QueryTests(test_utils.DatastoreTest):
     self.assertEqual(before[3], after[2])
     self.assertEqual(before[3], after[3])  # !!!
 
+  def testExport(self):
+    q = query.Query(kind='Foo').order(Foo.name)
+    cursors = []
+    res = list(q.export(batch_size=2, checkpoint=cursors.append))
+    self.assertEqual(res, [self.jill, self.joe, self.moe])
+    self.assertEqual(len(cursors), 2)  # One per batch.
+    # Resuming from the first checkpoint skips the first batch.
+    res = list(q.export(batch_size=2, start_cursor=cursors[0]))
+    self.assertEqual(res, [self.moe])
+    res = list(q.export(batch_size=2, start_cursor=cursors[1]))
+    self.assertEqual(res, [])
+
+  def testExportCheckpointInterval(self):
+    q = query.Query(kind='Foo').order(Foo.name)
+    cursors = []
+    gen = q.export(batch_size=1, checkpoint=cursors.append,
+                   checkpoint_interval=2)
+    self.assertEqual(gen.next(), self.jill)
+    self.assertEqual(gen.next(), self.joe)
+    self.assertEqual(cursors, [])  # Not until joe has been processed.
+    self.assertEqual(gen.next(), self.moe)
+    self.assertEqual(len(cursors), 1)
+    self.assertEqual(list(gen), [])
+    self.assertEqual(len(cursors), 2)  # After the last batch.
+
+  def testExportRaw(self):
+    q = query.Query(kind='Foo').order(Foo.name)
+    res = list(q.export(raw=True))
+    self.assertTrue(isinstance(res[0], entity_pb.EntityProto))
+    self.assertEqual([Foo._from_pb(pb) for pb in res],
+                     [self.jill, self.joe, self.moe])
+    res = list(q.export(raw=True, keys_only=True))
+    self.assertEqual(res, [self.jill.key, self.joe.key, self.moe.key])
+    self.assertRaises(datastore_errors.BadArgumentError, list,
+                      q.filter(Foo.rate.IN([1, 2])).export())
+
   def testCursorsKeysOnly(self):
     q = query.Query(kind='Foo')
     it = q.iter(produce_cursors=True, keys_only=True)
@@ -752,6 +863,16 @@ class QueryTests(test_utils.DatastoreTest):
     bindings[1].value = 'jill'
     self.assertEqual(list(qry), [self.jill])
 
+  def testResolveInBinding(self):
+    qry, options, bindings = query.parse_gql(
+      'SELECT * FROM Foo WHERE name IN :1')
+    bindings[1].value = ['joe']
+    self.assertEqual(list(qry), [self.joe])
+    self.assertEqual(qry.count(10), 1)
+    bindings[1].value = ['jill', 'moe']
+    self.assertEqual(list(qry), [self.jill, self.moe])
+    self.assertEqual(qry.count(10), 2)
+
   def testKeyFilter(self):
     class MyModel(model.Model):
       number = model.IntegerProperty()
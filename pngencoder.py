@@ -0,0 +1,288 @@
+"""Fast PNG encoding for rendered tiles.
+
+Tiles are coloured from a fixed palette, so many of them contain fewer than
+256 distinct colours. This module writes those tiles as 8-bit
+palette-indexed PNGs instead of 24-bit RGB, which is lossless. Tiles with
+more colours, such as boundary and deep tiles, are written as RGB unless
+quantizing down to the 256 most common colours is explicitly requested.
+
+The zlib compression level and the scanline filter are both tunable; by
+default the filter is chosen per tile, using the usual heuristics from the
+PNG specification: no filtering for palette images, and the filter with the
+minimum sum of absolute differences, chosen row by row, for truecolour ones.
+
+Images too large to hold in memory can be written a block of rows at a time
+with PNGWriter.
+"""
+
+import struct
+import zlib
+
+import numpy
+
+DEFAULT_LEVEL = 6  # zlib compression level, 0-9
+MAX_PALETTE = 256  # Most colours an 8-bit palette image can hold
+
+# PNG scanline filter types
+FILTER_NONE = 0
+FILTER_SUB = 1
+FILTER_UP = 2
+FILTER_ADAPTIVE = None  # Choose a filter per tile (and per row for RGB)
+
+PNG_SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+# PNG colour types
+COLOR_RGB = 2
+COLOR_PALETTE = 3
+
+
+def _chunk(tag, data):
+  """Returns a single PNG chunk with its length and checksum."""
+  crc = zlib.crc32(tag)
+  crc = zlib.crc32(data, crc) & 0xffffffff
+  return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', crc)
+
+
+def as_array(img):
+  """Returns an RGB image as a (height, width, 3) uint8 numpy array.
+
+  Args:
+    img: A PIL Image or a numpy array.
+  """
+  if isinstance(img, numpy.ndarray):
+    pixels = img
+  else:
+    if img.mode != 'RGB':
+      img = img.convert('RGB')
+    pixels = numpy.asarray(img)
+  return numpy.ascontiguousarray(pixels, dtype=numpy.uint8)
+
+
+def palettize(pixels, max_colors=MAX_PALETTE, quantize=False):
+  """Converts RGB pixels to palette indices.
+
+  If the image has more than max_colors distinct colours and quantize is
+  True, the most frequent max_colors are kept and every other colour is
+  mapped to its nearest neighbour among them, which is lossy.
+
+  Args:
+    pixels: A (height, width, 3) uint8 array.
+    max_colors: The maximum number of palette entries to use.
+    quantize: Whether to quantize images with too many colours.
+  Returns:
+    An (indices, palette) tuple, where indices is a (height, width) uint8
+    array and palette is an (n, 3) uint8 array with n <= max_colors; or
+    None if the image has too many colours and quantize is False.
+  """
+  height, width = pixels.shape[:2]
+  flat = pixels.reshape(height * width, 3).astype(numpy.uint32)
+  packed = (flat[:, 0] << 16) | (flat[:, 1] << 8) | flat[:, 2]
+  colors, inverse = numpy.unique(packed, return_inverse=True)
+
+  if len(colors) > max_colors:
+    if not quantize:
+      return None
+    counts = numpy.bincount(inverse)
+    keep = numpy.sort(numpy.argsort(counts)[-max_colors:])
+    rgb = _unpack(colors).astype(numpy.float32)
+    kept = rgb[keep]
+    # Map every colour to the nearest kept colour, by squared RGB distance.
+    # |a - b|^2 = |b|^2 - 2a.b + |a|^2, and |a|^2 doesn't affect the argmin,
+    # so this is a single matrix product. Colours are processed in blocks to
+    # bound the size of the distance array.
+    kept_norms = (kept ** 2).sum(axis=1)
+    remap = numpy.empty(len(colors), dtype=numpy.intp)
+    for start in xrange(0, len(colors), 4096):
+      block = rgb[start:start + 4096]
+      distance = kept_norms - 2 * numpy.dot(block, kept.T)
+      remap[start:start + 4096] = distance.argmin(axis=1)
+    inverse = remap[inverse]
+    colors = colors[keep]
+
+  indices = inverse.astype(numpy.uint8).reshape(height, width)
+  return indices, _unpack(colors).astype(numpy.uint8)
+
+
+def _unpack(packed):
+  return numpy.column_stack(((packed >> 16) & 0xff,
+                             (packed >> 8) & 0xff,
+                             packed & 0xff))
+
+
+def filter_rows(rows, bpp, filter_type=FILTER_ADAPTIVE):
+  """Applies PNG scanline filtering to an image.
+
+  Args:
+    rows: A (height, rowbytes) uint8 array of raw scanlines.
+    bpp: Bytes per complete pixel, used by the Sub filter.
+    filter_type: One of the FILTER_* constants. FILTER_ADAPTIVE picks, for
+      each row, the filter whose output has the smallest sum of absolute
+      (signed) byte values.
+  Returns:
+    A (height, rowbytes + 1) uint8 array of filtered scanlines, each
+    prefixed with its filter type byte.
+  """
+  height, rowbytes = rows.shape
+  out = numpy.empty((height, rowbytes + 1), dtype=numpy.uint8)
+  if filter_type == FILTER_NONE:
+    out[:, 0] = FILTER_NONE
+    out[:, 1:] = rows
+    return out
+
+  # uint8 arithmetic wraps modulo 256, exactly as the PNG filters require.
+  sub = rows.copy()
+  sub[:, bpp:] -= rows[:, :-bpp]
+  up = rows.copy()
+  up[1:] -= rows[:-1]
+  candidates = {FILTER_NONE: rows, FILTER_SUB: sub, FILTER_UP: up}
+
+  if filter_type is FILTER_ADAPTIVE:
+    order = sorted(candidates)
+    costs = numpy.array([
+        numpy.abs(candidates[f].view(numpy.int8).astype(numpy.int32)).sum(
+            axis=1) for f in order])
+    choice = numpy.array(order, dtype=numpy.uint8)[costs.argmin(axis=0)]
+    out[:, 0] = choice
+    for f in order:
+      mask = choice == f
+      out[mask, 1:] = candidates[f][mask]
+  else:
+    out[:, 0] = filter_type
+    out[:, 1:] = candidates[filter_type]
+  return out
+
+
+def encode(img, palette=True, level=DEFAULT_LEVEL, filter_type=FILTER_ADAPTIVE,
+           quantize=False):
+  """Encodes an image as a PNG.
+
+  Args:
+    img: A PIL Image or a (height, width, 3) uint8 numpy array.
+    palette: If True, write an 8-bit palette-indexed image when the image
+      has at most 256 distinct colours, and 24-bit RGB otherwise. If False,
+      always write 24-bit RGB.
+    level: zlib compression level, 0-9.
+    filter_type: One of the FILTER_* constants.
+    quantize: If True (and palette is True), always write a palette image,
+      quantizing to the 256 most frequent colours if necessary. This loses
+      detail, so it is off by default.
+  Returns:
+    A string containing the encoded PNG.
+  """
+  pixels = as_array(img)
+  height, width = pixels.shape[:2]
+
+  palettized = None
+  if palette:
+    palettized = palettize(pixels, quantize=quantize)
+  if palettized is not None:
+    indices, colors = palettized
+    color_type = COLOR_PALETTE
+    rows = indices
+    bpp = 1
+    if filter_type is FILTER_ADAPTIVE:
+      # Filtering rarely helps palette images, whose index deltas are noise.
+      filter_type = FILTER_NONE
+  else:
+    color_type = COLOR_RGB
+    rows = pixels.reshape(height, width * 3)
+    bpp = 3
+
+  filtered = filter_rows(rows, bpp, filter_type)
+  if filter_type == FILTER_NONE:
+    strategy = zlib.Z_DEFAULT_STRATEGY
+  else:
+    strategy = zlib.Z_FILTERED
+  compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS,
+                                zlib.DEF_MEM_LEVEL, strategy)
+  data = compressor.compress(filtered.tostring()) + compressor.flush()
+
+  parts = [
+      PNG_SIGNATURE,
+      _chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type,
+                                 0, 0, 0)),
+  ]
+  if palettized is not None:
+    parts.append(_chunk('PLTE', colors.tostring()))
+  parts.append(_chunk('IDAT', data))
+  parts.append(_chunk('IEND', ''))
+  return ''.join(parts)
+
+
+class PNGWriter(object):
+  """Writes a truecolour PNG to a file incrementally, a block of rows at a time.
+
+  Only the compressor's state and the previous row are kept between blocks,
+  so memory use doesn't depend on the size of the image.
+  """
+
+  IDAT_SIZE = 1 << 16 # Largest IDAT chunk to write
+
+  def __init__(self, fh, width, height, level=DEFAULT_LEVEL,
+               filter_type=FILTER_ADAPTIVE):
+    """Constructor.
+
+    Args:
+      fh: A file-like object to write to.
+      width, height: The image's dimensions.
+      level: zlib compression level, 0-9.
+      filter_type: One of the FILTER_* constants.
+    """
+    self.fh = fh
+    self.width = width
+    self.height = height
+    self.filter_type = filter_type
+    self.rows_written = 0
+    self.previous = None
+    if filter_type == FILTER_NONE:
+      strategy = zlib.Z_DEFAULT_STRATEGY
+    else:
+      strategy = zlib.Z_FILTERED
+    self.compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS,
+                                       zlib.DEF_MEM_LEVEL, strategy)
+    self.pending = []
+    self.pending_size = 0
+    fh.write(PNG_SIGNATURE)
+    fh.write(_chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8,
+                                        COLOR_RGB, 0, 0, 0)))
+
+  def write(self, img):
+    """Appends rows to the image.
+
+    Args:
+      img: A PIL Image or a (rows, width, 3) uint8 numpy array.
+    """
+    pixels = as_array(img)
+    rows = pixels.reshape(len(pixels), self.width * 3)
+    if self.rows_written + len(rows) > self.height:
+      raise ValueError('Too many rows written')
+    if self.previous is not None:
+      # Filter with the previous block's last row above, then drop it.
+      filtered = filter_rows(numpy.vstack((self.previous, rows)), 3,
+                             self.filter_type)[1:]
+    else:
+      filtered = filter_rows(rows, 3, self.filter_type)
+    self.previous = rows[-1:].copy()
+    self.rows_written += len(rows)
+    self._write_data(self.compressor.compress(filtered.tostring()))
+
+  def _write_data(self, data):
+    self.pending.append(data)
+    self.pending_size += len(data)
+    if self.pending_size >= self.IDAT_SIZE:
+      self._flush_idat()
+
+  def _flush_idat(self):
+    if self.pending_size:
+      self.fh.write(_chunk('IDAT', ''.join(self.pending)))
+    self.pending = []
+    self.pending_size = 0
+
+  def close(self):
+    """Finishes the image. Every row must have been written."""
+    if self.rows_written != self.height:
+      raise ValueError('Expected %d rows, got %d' % (self.height,
+                                                     self.rows_written))
+    self._write_data(self.compressor.flush())
+    self._flush_idat()
+    self.fh.write(_chunk('IEND', ''))
@@ -0,0 +1,128 @@
+"""Per-stage timing of the tile pipeline, aggregated into latency histograms.
+
+Rendering a tile passes through several stages: datastore gets, routing,
+fetching stripes from the backends, decoding and pasting them, encoding the
+tile, writing it to the blobstore and putting it in the datastore. A Trace
+accumulates the time spent in each stage while a tile is rendered; when the
+tile is done, record() adds each stage's time to a histogram for the tile's
+level, kept in memcache so that all instances contribute to it.
+
+Stripes are fetched in parallel, so the per-stripe stages add up to more
+than the wall time of the tile.
+"""
+
+import bisect
+import contextlib
+import logging
+import time
+
+from google.appengine.api import memcache
+
+NAMESPACE = 'trace' # Memcache namespace for histograms
+MAX_LEVEL = 48 # Deepest level histograms are reported for
+BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+           20000, 60000] # Upper bounds of histogram buckets, in milliseconds
+
+# Stages, in pipeline order.
+STAGES = (
+    'datastore_get',
+    'routing',
+    'backend_fetch',
+    'backend_kernel',
+    'backend_encode',
+    'png_decode',
+    'paste',
+    'png_encode',
+    'blobstore_write',
+    'datastore_put',
+    'total',
+)
+
+
+class Trace(object):
+  """The time spent in each stage while rendering one tile."""
+
+  def __init__(self, level):
+    self.level = level
+    self.spans = {} # Maps stage names to seconds
+
+  @contextlib.contextmanager
+  def span(self, stage):
+    """Times the enclosed block, adding it to stage.
+
+    This may enclose a yield in a tasklet, in which case the time other
+    tasklets run for is included.
+    """
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.add(stage, time.time() - start)
+
+  def add(self, stage, seconds):
+    self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+
+  def record(self):
+    """Adds this trace's spans to the histograms for its level."""
+    offsets = {}
+    for stage, seconds in self.spans.iteritems():
+      milliseconds = int(seconds * 1000)
+      offsets[_key(self.level, stage, bucket(milliseconds))] = 1
+      offsets[_key(self.level, stage, 'sum')] = milliseconds
+    memcache.offset_multi(offsets, namespace=NAMESPACE, initial_value=0)
+    logging.info("Trace for level %d: %s", self.level, ', '.join(
+        '%s=%.3f' % (stage, self.spans[stage])
+        for stage in STAGES if stage in self.spans))
+
+
+def bucket(milliseconds):
+  """Returns the index of the histogram bucket a duration falls in."""
+  return bisect.bisect_left(BUCKETS, milliseconds)
+
+
+def _key(level, stage, bucket_index):
+  return '%d/%s/%s' % (level, stage, bucket_index)
+
+
+def histograms():
+  """Fetches the latency histograms for every level with any traces.
+
+  Returns:
+    A dict mapping (level, stage) tuples to (counts, total milliseconds)
+    tuples, where counts has one entry per bucket, plus one for durations
+    longer than the last bucket.
+  """
+  # Every trace has a total, so that finds the levels with any data.
+  totals = memcache.get_multi(
+      [_key(level, 'total', 'sum') for level in range(MAX_LEVEL + 1)],
+      namespace=NAMESPACE)
+  levels = [level for level in range(MAX_LEVEL + 1)
+            if _key(level, 'total', 'sum') in totals]
+  keys = [_key(level, stage, suffix)
+          for level in levels for stage in STAGES
+          for suffix in range(len(BUCKETS) + 1) + ['sum']]
+  values = memcache.get_multi(keys, namespace=NAMESPACE)
+  result = {}
+  for level in levels:
+    for stage in STAGES:
+      counts = [int(values.get(_key(level, stage, i), 0))
+                for i in range(len(BUCKETS) + 1)]
+      if any(counts):
+        result[(level, stage)] = (
+            counts, int(values.get(_key(level, stage, 'sum'), 0)))
+  return result
+
+
+def percentile(counts, fraction):
+  """Returns the upper bound of the bucket containing a percentile.
+
+  Returns:
+    A bound in milliseconds, or None if it's beyond the last bucket.
+  """
+  target = fraction * sum(counts)
+  seen = 0
+  for i, count in enumerate(counts):
+    seen += count
+    if seen >= target:
+      return BUCKETS[i] if i < len(BUCKETS) else None
+  return None